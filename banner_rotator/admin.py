@@ -1,13 +1,15 @@
 #-*- coding:utf-8 -*-
 
+import csv
 import logging
 
 from django import forms, template
 from django.contrib import admin
 from django.contrib.admin.util import unquote
-from django.db import models
+from django.db import connection, models
+from django.http import HttpResponse
 from django.shortcuts import get_object_or_404, render_to_response
-from django.utils.encoding import force_unicode
+from django.utils.encoding import force_unicode, smart_str
 from django.utils.functional import update_wrapper
 from django.utils.text import capfirst
 from django.utils.translation import ugettext_lazy as _
@@ -32,13 +34,15 @@ class CampaignBannerInline(admin.StackedInline):
 
 
 class CampaignAdmin(admin.ModelAdmin):
-    list_display = ('name', 'created_at', 'updated_at')
-    fields = ('name',)
+    list_display = ('name', 'max_views', 'max_clicks', 'daily_max_views', 'daily_max_clicks', 'created_at',
+                    'updated_at')
+    fields = ('name', 'max_views', 'max_clicks', 'daily_max_views', 'daily_max_clicks')
     inlines = [CampaignBannerInline]
 
 
 class BannerAdmin(admin.ModelAdmin):
-    list_display = ('name', 'campaign', 'weight', 'url', 'views', 'is_active')
+    list_display = ('name', 'campaign', 'admin_places_str', 'weight', 'url', 'admin_views_str', 'admin_clicks_str',
+                    'admin_ctr_str', 'is_active')
     list_filter = ('campaign', 'places', 'is_active')
     date_hierarchy = 'created_at'
     fieldsets = (
@@ -58,6 +62,21 @@ class BannerAdmin(admin.ModelAdmin):
     readonly_fields = ('views', 'click_count',)
 
     object_log_clicks_template = None
+    log_clicks_per_page = 100
+    log_clicks_csv_chunk_size = 1000
+
+    def queryset(self, request):
+        """
+        Changelist rows come with their campaign and places in a constant number
+        of queries; clicks and CTR are read from the banner counters, not the Click table
+        """
+        # Qualified, so the columns stay unambiguous whatever the filters join
+        table = connection.ops.quote_name(Banner._meta.db_table)
+        return super(BannerAdmin, self).queryset(request).select_related('campaign').prefetch_related(
+            'places').extra(select={
+                'click_through_rate': 'CASE WHEN %(table)s.views > 0 THEN 1.0 * %(table)s.click_count / '
+                                      '%(table)s.views ELSE 0 END' % {'table': table},
+            })
 
     def get_urls(self):
         try:
@@ -79,6 +98,7 @@ class BannerAdmin(admin.ModelAdmin):
             url(r'^(.+)/history/$', wrap(self.history_view), name='%s_%s_history' % info),
             url(r'^(.+)/delete/$', wrap(self.delete_view), name='%s_%s_delete' % info),
             url(r'^(.+)/log/clicks/$', wrap(self.log_clicks_view), name='%s_%s_log_clicks' % info),
+            url(r'^(.+)/log/clicks/csv/$', wrap(self.log_clicks_csv_view), name='%s_%s_log_clicks_csv' % info),
             url(r'^(.+)/$', wrap(self.change_view), name='%s_%s_change' % info),
         )
         return urlpatterns
@@ -90,12 +110,19 @@ class BannerAdmin(admin.ModelAdmin):
 
         obj = get_object_or_404(model, pk=unquote(object_id))
 
+        log_clicks = list(self.get_log_clicks(obj, request.GET.get('before'))[:self.log_clicks_per_page + 1])
+        next_before = None
+        if len(log_clicks) > self.log_clicks_per_page:
+            log_clicks = log_clicks[:self.log_clicks_per_page]
+            next_before = log_clicks[-1].pk
+
         context = {
             'title': _('Log clicks'),
             'module_name': capfirst(force_unicode(opts.verbose_name_plural)),
             'object': obj,
             'app_label': app_label,
-            'log_clicks': Click.objects.filter(banner=obj).order_by('-datetime')
+            'log_clicks': log_clicks,
+            'next_before': next_before,
         }
         context.update(extra_context or {})
         context_instance = template.RequestContext(request, current_app=self.admin_site.name)
@@ -104,6 +131,47 @@ class BannerAdmin(admin.ModelAdmin):
             "admin/%s/object_log_clicks.html" % app_label,
         ], context, context_instance=context_instance)
 
+    def get_log_clicks(self, obj, before=None):
+        """
+        Clicks of obj, newest first, older than the click with pk before.
+
+        Pages are sliced by (datetime, id) instead of OFFSET so that every page
+        is a range scan of the (banner_id, datetime) index.
+        """
+        clicks = Click.objects.filter(banner=obj).select_related('user', 'place').order_by('-datetime', '-id')
+        try:
+            before_datetime = Click.objects.filter(banner=obj, pk=int(before)).values_list('datetime', flat=True)[0]
+        except (TypeError, ValueError, IndexError):
+            return clicks
+        return clicks.filter(models.Q(datetime__lt=before_datetime) |
+                             models.Q(datetime=before_datetime, id__lt=int(before)))
+
+    def log_clicks_csv_view(self, request, object_id):
+        obj = get_object_or_404(self.model, pk=unquote(object_id))
+
+        class Echo(object):
+            def write(self, value):
+                return value
+
+        writer = csv.writer(Echo())
+
+        def rows():
+            yield writer.writerow(['datetime', 'place', 'user', 'ip', 'user_agent', 'referrer'])
+            before = None
+            while True:
+                chunk = list(self.get_log_clicks(obj, before)[:self.log_clicks_csv_chunk_size])
+                for click in chunk:
+                    yield writer.writerow([smart_str(value or '') for value in (
+                        click.datetime.isoformat(), click.place and click.place.slug,
+                        click.user and click.user.username, click.ip, click.user_agent, click.referrer)])
+                if len(chunk) < self.log_clicks_csv_chunk_size:
+                    break
+                before = chunk[-1].pk
+
+        response = HttpResponse(rows(), content_type='text/csv')
+        response['Content-Disposition'] = 'attachment; filename=banner-%s-clicks.csv' % obj.pk
+        return response
+
 
 admin.site.register(Banner, BannerAdmin)
 admin.site.register(Campaign, CampaignAdmin)
@@ -0,0 +1,116 @@
+#-*- coding:utf-8 -*-
+"""
+Coroutine variants of the serving path for asyncio (ASGI) servers, Python 3.7+ only.
+
+Work that only touches process memory is done in the event loop; anything
+that may wait on the database, the counter backend or the cache runs in a
+bounded pool of BANNER_ROTATOR_ASYNC_THREADS threads, so the event loop is
+never blocked and a slow write ties up one pool thread instead of one
+worker per request.
+
+    async def click_view(request, banner_id):
+        return await aio.click(request, banner_id)
+"""
+
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+from django.db import connections
+
+from banner_rotator import pacing
+from banner_rotator import settings as banner_settings
+
+
+_executor = []
+_lock = threading.Lock()
+
+
+def get_executor():
+    if not _executor:
+        with _lock:
+            if not _executor:
+                _executor.append(ThreadPoolExecutor(banner_settings.ASYNC_THREADS))
+    return _executor[0]
+
+
+def call(func, *args, **kwargs):
+    """
+    Calls func and closes the database connections it opened in this pool thread,
+    like the request_finished signal does for the threads of a WSGI server
+    """
+    try:
+        return func(*args, **kwargs)
+    finally:
+        for connection in connections.all():
+            connection.close()
+
+
+async def run(func, *args, **kwargs):
+    """
+    Calls func in the thread pool
+    """
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(get_executor(), partial(call, func, *args, **kwargs))
+
+
+async def biased_choice(place):
+    """
+    Banner.objects.biased_choice(), without a thread switch while the place snapshot
+    is loaded and the pacers are not due to read the counter backend
+    """
+    from banner_rotator.models import Banner
+    from banner_rotator.snapshot import snapshots
+
+    if snapshots.is_loaded(getattr(place, 'pk', place)) and not pacing.is_due():
+        return Banner.objects.biased_choice(place)
+    return await run(Banner.objects.biased_choice, place)
+
+
+async def biased_choices(places, unique=None):
+    from banner_rotator.models import Banner
+    from banner_rotator.snapshot import snapshots
+
+    if all(snapshots.is_loaded(place.pk) for place in places) and not pacing.is_due():
+        return Banner.objects.biased_choices(places, unique=unique)
+    return await run(Banner.objects.biased_choices, places, unique=unique)
+
+
+async def serve(place):
+    from banner_rotator.models import Banner
+
+    return await run(Banner.objects.serve, place)
+
+
+async def serve_many(places, unique=None):
+    from banner_rotator.models import Banner
+
+    return await run(Banner.objects.serve_many, places, unique=unique)
+
+
+async def click(request, banner_id):
+    """
+    views.click(), run in the thread pool as it may record the click and load request.user
+    """
+    from banner_rotator import views
+
+    return await run(views.click, request, banner_id)
+
+
+async def token_click(request, token):
+    from banner_rotator import views
+
+    return await run(views.token_click, request, token)
+
+
+async def flush_views():
+    from banner_rotator.counters import view_buffer
+
+    return await run(view_buffer.flush)
+
+
+async def flush_clicks():
+    from banner_rotator.click_queue import click_queue
+
+    return await run(click_queue.flush)
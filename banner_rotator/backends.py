@@ -0,0 +1,277 @@
+#-*- coding:utf-8 -*-
+
+import threading
+
+from django.core.exceptions import ImproperlyConfigured
+from django.db.models import F
+
+from banner_rotator import settings as banner_settings
+
+
+COUNTER_FIELDS = ('views', 'click_count')
+
+
+class BaseCounterBackend(object):
+    """
+    Keeps the views and click_count totals of banners.
+
+    Totals are keyed by the Banner column name ('views' or 'click_count')
+    and banner id. Backends that do not write the Banner table themselves
+    are copied back to it by the reconcile_banner_counters command.
+    """
+    writes_model = False
+
+    def incr_many(self, field, counts):
+        """
+        Adds {banner_id: n} to field and returns {banner_id: new total}
+        """
+        raise NotImplementedError
+
+    def get_many(self, field, banner_ids):
+        """
+        Returns {banner_id: total} for the banners the backend knows about
+        """
+        raise NotImplementedError
+
+    def seed_many(self, field, totals):
+        """
+        Stores {banner_id: total} for the banners the backend does not know about yet
+        """
+        raise NotImplementedError
+
+    def reserve(self, banner):
+        """
+        Counts one view of a banner with caps unless it is exhausted, returns
+        False if it is. The view total is incremented first and given back
+        if it went over max_views, so concurrent reservations never overshoot.
+        """
+        if banner.max_clicks > 0:
+            if self.get_many('click_count', [banner.pk]).get(banner.pk, 0) >= banner.max_clicks:
+                return False
+        total = self.incr_many('views', {banner.pk: 1})[banner.pk]
+        if banner.max_views > 0 and total > banner.max_views:
+            self.incr_many('views', {banner.pk: -1})
+            return False
+        return True
+
+    def load(self, banners):
+        """
+        Seeds the backend from the model columns and copies its totals onto banners
+        """
+        banner_ids = [banner.pk for banner in banners]
+        for field in COUNTER_FIELDS:
+            self.seed_many(field, dict((banner.pk, getattr(banner, field) or 0) for banner in banners))
+            totals = self.get_many(field, banner_ids)
+            for banner in banners:
+                setattr(banner, field, totals.get(banner.pk, getattr(banner, field)))
+
+
+class DatabaseCounterBackend(BaseCounterBackend):
+    """
+    Counts straight in the Banner columns with atomic UPDATE ... SET field = field + n
+    """
+    writes_model = True
+
+    def incr_many(self, field, counts):
+        from banner_rotator.models import Banner
+
+        by_increment = {}
+        for banner_id, count in counts.items():
+            by_increment.setdefault(count, []).append(banner_id)
+        for count, banner_ids in by_increment.items():
+            Banner.objects.filter(pk__in=banner_ids).update(**{field: F(field) + count})
+        return self.get_many(field, list(counts))
+
+    def get_many(self, field, banner_ids):
+        from banner_rotator.models import Banner
+
+        return dict(Banner.objects.filter(pk__in=banner_ids).values_list('pk', field))
+
+    def reserve(self, banner):
+        """
+        UPDATE ... SET views = views + 1 WHERE is_active AND views < max_views
+        AND click_count < max_clicks, so the row lock is only taken by the write
+        """
+        from banner_rotator.models import Banner
+
+        banners = Banner.objects.filter(pk=banner.pk, is_active=True)
+        if banner.max_views > 0:
+            banners = banners.filter(views__lt=F('max_views'))
+        if banner.max_clicks > 0:
+            banners = banners.filter(click_count__lt=F('max_clicks'))
+        return bool(banners.update(views=F('views') + 1))
+
+    def seed_many(self, field, totals):
+        pass
+
+    def load(self, banners):
+        pass
+
+
+class CacheCounterBackend(BaseCounterBackend):
+    """
+    Counts in a Django cache. Only atomic when the cache implements incr()
+    atomically (memcached, redis).
+    """
+
+    def __init__(self, alias='default', prefix='banner_rotator', timeout=7 * 24 * 3600):
+        from django.core.cache import get_cache
+
+        self.cache = get_cache(alias)
+        self.prefix = prefix
+        self.timeout = timeout
+
+    def _key(self, field, banner_id):
+        return '%s:%s:%s' % (self.prefix, field, banner_id)
+
+    def incr_many(self, field, counts):
+        totals = {}
+        for banner_id, count in counts.items():
+            key = self._key(field, banner_id)
+            try:
+                totals[banner_id] = self.cache.incr(key, count)
+            except ValueError:
+                # Never seeded or evicted: start from the model column
+                from banner_rotator.models import Banner
+
+                current = Banner.objects.filter(pk=banner_id).values_list(field, flat=True)
+                self.cache.add(key, (current and current[0]) or 0, self.timeout)
+                totals[banner_id] = self.cache.incr(key, count)
+        return totals
+
+    def get_many(self, field, banner_ids):
+        found = self.cache.get_many([self._key(field, banner_id) for banner_id in banner_ids])
+        return dict((banner_id, found[self._key(field, banner_id)]) for banner_id in banner_ids
+                    if self._key(field, banner_id) in found)
+
+    def seed_many(self, field, totals):
+        for banner_id, total in totals.items():
+            self.cache.add(self._key(field, banner_id), total, self.timeout)
+
+
+class RedisCounterBackend(BaseCounterBackend):
+    """
+    Counts in one Redis hash per field with HINCRBY.
+
+    url is passed to redis.StrictRedis.from_url(), 'locmem://' uses the
+    in-process LocalRedis stand-in instead (for tests and development).
+    """
+
+    def __init__(self, url='redis://localhost:6379/0', prefix='banner_rotator', client=None):
+        self.client = client or redis_client(url)
+        self.prefix = prefix
+
+    def _key(self, field):
+        return '%s:%s' % (self.prefix, field)
+
+    def incr_many(self, field, counts):
+        pipe = self.client.pipeline()
+        banner_ids = list(counts)
+        for banner_id in banner_ids:
+            pipe.hincrby(self._key(field), banner_id, counts[banner_id])
+        return dict(zip(banner_ids, [int(total) for total in pipe.execute()]))
+
+    def get_many(self, field, banner_ids):
+        if not banner_ids:
+            return {}
+        totals = self.client.hmget(self._key(field), banner_ids)
+        return dict((banner_id, int(total)) for banner_id, total in zip(banner_ids, totals)
+                    if total is not None)
+
+    def seed_many(self, field, totals):
+        pipe = self.client.pipeline()
+        for banner_id, total in totals.items():
+            pipe.hsetnx(self._key(field), banner_id, total)
+        pipe.execute()
+
+
+class LocalRedis(object):
+    """
+    In-memory stand-in for the part of the redis.StrictRedis API used by RedisCounterBackend
+    """
+
+    def __init__(self):
+        self._hashes = {}
+        self._lock = threading.RLock()
+
+    def pipeline(self):
+        return LocalRedisPipeline(self)
+
+    def hincrby(self, name, key, amount=1):
+        with self._lock:
+            values = self._hashes.setdefault(name, {})
+            values[str(key)] = str(int(values.get(str(key), 0)) + amount)
+            return int(values[str(key)])
+
+    def hsetnx(self, name, key, value):
+        with self._lock:
+            values = self._hashes.setdefault(name, {})
+            if str(key) in values:
+                return 0
+            values[str(key)] = str(value)
+            return 1
+
+    def hmget(self, name, keys):
+        with self._lock:
+            values = self._hashes.get(name, {})
+            return [values.get(str(key)) for key in keys]
+
+    def hgetall(self, name):
+        with self._lock:
+            return dict(self._hashes.get(name, {}))
+
+    def flushdb(self):
+        with self._lock:
+            self._hashes.clear()
+
+
+class LocalRedisPipeline(object):
+
+    def __init__(self, client):
+        self.client = client
+        self._calls = []
+
+    def __getattr__(self, name):
+        method = getattr(self.client, name)
+
+        def queue(*args, **kwargs):
+            self._calls.append((method, args, kwargs))
+            return self
+        return queue
+
+    def execute(self):
+        with self.client._lock:
+            calls, self._calls = self._calls, []
+            return [method(*args, **kwargs) for method, args, kwargs in calls]
+
+
+_local_redis = {}
+
+
+def redis_client(url):
+    if url.startswith('locmem://'):
+        return _local_redis.setdefault(url, LocalRedis())
+    try:
+        import redis
+    except ImportError:
+        raise ImproperlyConfigured('RedisCounterBackend requires the redis package')
+    return redis.StrictRedis.from_url(url)
+
+
+_backend = []
+
+
+def get_backend():
+    """
+    Returns the BANNER_ROTATOR_COUNTER_BACKEND instance, created on first use
+    """
+    if not _backend:
+        from django.utils.importlib import import_module
+
+        module_name, class_name = banner_settings.COUNTER_BACKEND.rsplit('.', 1)
+        try:
+            backend_class = getattr(import_module(module_name), class_name)
+        except (ImportError, AttributeError):
+            raise ImproperlyConfigured('Could not import counter backend %s' % banner_settings.COUNTER_BACKEND)
+        _backend.append(backend_class(**banner_settings.COUNTER_OPTIONS))
+    return _backend[0]
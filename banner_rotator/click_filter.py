@@ -0,0 +1,75 @@
+#-*- coding:utf-8 -*-
+
+import hashlib
+import math
+import re
+import struct
+
+from banner_rotator import settings as banner_settings
+from banner_rotator.tokens import RecentSet
+
+
+class BloomFilter(object):
+    """
+    Set of byte strings in a fixed bit array, sized for capacity values at
+    error_rate false positives. Never answers False for a value that was added.
+    """
+
+    def __init__(self, capacity, error_rate):
+        self.size = int(math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hashes = max(1, int(round(self.size / float(capacity) * math.log(2))))
+        self.count = 0
+        self._bits = bytearray((self.size + 7) // 8)
+
+    def _positions(self, value):
+        # Double hashing: k positions from the two halves of one md5 digest
+        first, second = struct.unpack('<QQ', hashlib.md5(value).digest())
+        return [(first + i * second) % self.size for i in range(self.hashes)]
+
+    def __contains__(self, value):
+        return all(self._bits[position >> 3] & (1 << (position & 7)) for position in self._positions(value))
+
+    def __len__(self):
+        return self.count
+
+    def add(self, value):
+        for position in self._positions(value):
+            self._bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+
+class RotatingBloomFilter(RecentSet):
+    """
+    RecentSet in two rotating Bloom filters of capacity values each, so
+    memory stays fixed. add() returns False if value was probably seen.
+    """
+
+    def __init__(self, window, capacity, error_rate=0.001):
+        self.error_rate = error_rate
+        super(RotatingBloomFilter, self).__init__(window, capacity)
+
+    def new_set(self):
+        return BloomFilter(self.max_size, self.error_rate)
+
+
+bot_user_agent = re.compile(banner_settings.CLICK_BOT_USER_AGENTS, re.IGNORECASE)
+
+_recent_clicks = RotatingBloomFilter(banner_settings.CLICK_DEDUP_WINDOW, banner_settings.CLICK_DEDUP_CAPACITY)
+
+
+def is_bot(user_agent):
+    return bool(user_agent and bot_user_agent.search(user_agent))
+
+
+def accept_click(request, banner_id):
+    """
+    False for clicks from crawlers and for repeated clicks on banner_id from
+    the same IP address and user agent within BANNER_ROTATOR_CLICK_DEDUP_WINDOW
+    """
+    user_agent = request.META.get('HTTP_USER_AGENT') or ''
+    if is_bot(user_agent):
+        return False
+    if not banner_settings.CLICK_DEDUP_WINDOW:
+        return True
+    key = u'%s|%s|%s' % (banner_id, request.META.get('REMOTE_ADDR'), user_agent)
+    return _recent_clicks.add(key.encode('utf-8'))
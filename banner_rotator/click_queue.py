@@ -0,0 +1,127 @@
+#-*- coding:utf-8 -*-
+
+import atexit
+import logging
+import threading
+
+try:
+    from Queue import Queue, Empty, Full
+except ImportError:
+    from queue import Queue, Empty, Full
+
+from banner_rotator import settings as banner_settings
+from banner_rotator.click_filter import accept_click
+from banner_rotator.counters import count_clicks
+
+
+logger = logging.getLogger('banner_rotator')
+
+
+def save_clicks(clicks):
+    """
+    Inserts unsaved Click instances with one bulk_create and counts them on their banners
+    """
+    from banner_rotator.models import Click
+
+    Click.objects.bulk_create(clicks)
+    count_clicks(clicks)
+
+
+def record_click(request, banner_id, place_id=None, impression_id=None):
+    """
+    Logs and counts a click on banner_id, queued when BANNER_ROTATOR_CLICKS_ASYNC is on.
+    impression_id is the one of the signed click URL, if the click came from one.
+    Returns None for bot and duplicate clicks, which are not recorded.
+    """
+    from banner_rotator.models import Click
+
+    if not accept_click(request, banner_id):
+        return None
+
+    click = Click(
+        banner_id=banner_id,
+        place_id=place_id,
+        impression_id=impression_id,
+        ip=request.META.get('REMOTE_ADDR'),
+        user_agent=request.META.get('HTTP_USER_AGENT'),
+        referrer=request.META.get('HTTP_REFERER'),
+    )
+
+    if request.user.is_authenticated():
+        click.user = request.user
+
+    if banner_settings.CLICKS_ASYNC and click_queue.put(click):
+        return click
+    if banner_settings.CLICKS_ASYNC and banner_settings.CLICKS_QUEUE_FULL == 'drop':
+        logger.warning('Banner click queue is full, click on banner %s dropped', banner_id)
+        return click
+
+    click.save()
+    count_clicks([click])
+    return click
+
+
+class ClickQueue(object):
+    """
+    Bounded in-process queue of Click instances drained in batches by a daemon thread
+    """
+
+    def __init__(self, maxsize, batch_size):
+        self.batch_size = batch_size
+        self._queue = Queue(maxsize)
+        self._worker = None
+        self._lock = threading.Lock()
+
+    def put(self, click):
+        """
+        Returns False if the queue is full and the click was not queued
+        """
+        self._start()
+        try:
+            self._queue.put_nowait(click)
+        except Full:
+            return False
+        return True
+
+    def flush(self):
+        """
+        Writes whatever is still queued from the calling thread
+        """
+        batch = self._take(self.batch_size)
+        while batch:
+            self._save(batch)
+            batch = self._take(self.batch_size)
+
+    def _start(self):
+        if self._worker is not None and self._worker.is_alive():
+            return
+        with self._lock:
+            if self._worker is None or not self._worker.is_alive():
+                self._worker = threading.Thread(target=self._run, name='banner_rotator.clicks')
+                self._worker.daemon = True
+                self._worker.start()
+
+    def _take(self, count):
+        batch = []
+        while len(batch) < count:
+            try:
+                batch.append(self._queue.get_nowait())
+            except Empty:
+                break
+        return batch
+
+    def _save(self, batch):
+        try:
+            save_clicks(batch)
+        except Exception:
+            logger.exception('Failed to save %s banner clicks', len(batch))
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            batch.extend(self._take(self.batch_size - 1))
+            self._save(batch)
+
+
+click_queue = ClickQueue(banner_settings.CLICKS_QUEUE_SIZE, banner_settings.CLICKS_BATCH_SIZE)
+atexit.register(click_queue.flush)
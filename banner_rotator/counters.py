@@ -0,0 +1,249 @@
+#-*- coding:utf-8 -*-
+
+import atexit
+import datetime
+import logging
+import threading
+from time import time
+
+from django.db import transaction, IntegrityError
+from django.db.models import F
+
+from banner_rotator import instrumentation
+from banner_rotator import settings as banner_settings
+from banner_rotator.backends import get_backend
+from banner_rotator.snapshot import snapshots, click_targets, campaign_ledger
+
+
+logger = logging.getLogger('banner_rotator')
+
+def write_counts(field, cap_field, counts):
+    """
+    Adds {banner_id: n} to a counter through the counter backend and
+    deactivates the banners that reached their cap
+    """
+    from banner_rotator.models import Banner
+
+    totals = get_backend().incr_many(field, counts)
+
+    # Caps come from the banners and click targets held in memory, the database is only asked about the others
+    known = snapshots.update_counters(field, totals)
+    caps = dict((banner_id, getattr(banner, cap_field)) for banner_id, banner in known.items())
+    unknown = [banner_id for banner_id in totals if banner_id not in caps]
+    if unknown:
+        caps.update(click_targets.caps(cap_field, unknown))
+        unknown = [banner_id for banner_id in unknown if banner_id not in caps]
+    if unknown:
+        caps.update(Banner.objects.filter(pk__in=unknown).values_list('pk', cap_field))
+
+    deactivate([banner_id for banner_id, total in totals.items()
+                if caps.get(banner_id, 0) > 0 and (total or 0) >= caps[banner_id]])
+
+
+def deactivate(banner_ids):
+    from banner_rotator.models import Banner
+
+    if banner_ids and Banner.objects.filter(pk__in=banner_ids, is_active=True).update(is_active=False):
+        snapshots.invalidate()
+
+
+def count_campaigns(field, counts):
+    """
+    Adds {campaign_id: n} to the campaign ledger and deactivates the
+    banners of the campaigns that reached a total cap
+    """
+    from banner_rotator.models import Banner
+
+    spent = campaign_ledger.add(field, counts, datetime.date.today())
+    if spent:
+        deactivate(list(Banner.objects.filter(campaign__in=spent, is_active=True).values_list('pk', flat=True)))
+
+
+def write_views(counts):
+    write_counts('views', 'max_views', counts)
+
+
+def write_clicks(counts):
+    write_counts('click_count', 'max_clicks', counts)
+
+
+def get_hour(value=None):
+    return (value or datetime.datetime.now()).replace(minute=0, second=0, microsecond=0)
+
+
+def write_stats(field, counts):
+    """
+    Adds {(banner_id, place_id, hour): n} to the hourly BannerStat rollups
+    """
+    from banner_rotator.models import BannerStat
+
+    for (banner_id, place_id, hour), count in counts.items():
+        stats = BannerStat.objects.filter(banner=banner_id, place_key=place_id or 0, hour=hour)
+        if stats.update(**{field: F(field) + count}):
+            continue
+        # First count of the hour, another process may be inserting the same row
+        sid = transaction.savepoint()
+        try:
+            BannerStat(banner_id=banner_id, place_id=place_id, hour=hour, **{field: count}).save(force_insert=True)
+            transaction.savepoint_commit(sid)
+        except IntegrityError:
+            transaction.savepoint_rollback(sid)
+            stats.update(**{field: F(field) + count})
+
+
+def count_clicks(clicks):
+    """
+    Counts saved Click instances on their banners and in the hourly rollups
+    """
+    from banner_rotator.models import Banner
+
+    counts, stats = {}, {}
+    for click in clicks:
+        key = (click.banner_id, click.place_id, get_hour(click.datetime))
+        counts[click.banner_id] = counts.get(click.banner_id, 0) + 1
+        stats[key] = stats.get(key, 0) + 1
+    write_clicks(counts)
+    if banner_settings.STATS:
+        write_stats('clicks', stats)
+
+    if len(campaign_ledger):
+        campaigns = {}
+        for banner_id, campaign_id in Banner.objects.filter(pk__in=list(counts)).values_list('pk', 'campaign'):
+            if campaign_id in campaign_ledger:
+                campaigns[campaign_id] = campaigns.get(campaign_id, 0) + counts[banner_id]
+        count_campaigns('click_count', campaigns)
+
+
+class ViewBuffer(object):
+    """
+    Accumulates impressions per banner, place and hour in memory and writes
+    them at most once per interval seconds, from the next add() or from a
+    daemon timer thread once the interval is over.
+
+    With interval 0 every impression is written right away, which costs an
+    UPDATE and a SELECT of the banner and a BannerStat write per impression.
+    """
+
+    def __init__(self, interval):
+        self.interval = interval
+        self._pending = {}
+        self._reserved = {}
+        self._flushed_at = time()
+        self._timer = None
+        self._lock = threading.Lock()
+
+    def add(self, banner_id, place_id=None, count=1):
+        self.add_many({(banner_id, place_id, get_hour()): count})
+
+    def add_many(self, counts, reserved=False):
+        """
+        Adds {(banner_id, place_id, hour): n}. Reserved impressions are
+        already counted on the banner and only go to the rollups.
+        """
+        with self._lock:
+            pending = self._reserved if reserved else self._pending
+            for key, count in counts.items():
+                pending[key] = pending.get(key, 0) + count
+            due = time() - self._flushed_at >= self.interval
+            if not due and self._timer is None:
+                self._timer = threading.Timer(self.interval - (time() - self._flushed_at), self._run)
+                self._timer.daemon = True
+                self._timer.start()
+        if due:
+            self.flush()
+
+    def flush(self):
+        """
+        Writes the buffered impressions and returns them. Impressions that
+        could not be written are kept for the next flush.
+        """
+        with self._lock:
+            pending, self._pending = self._pending, {}
+            reserved, self._reserved = self._reserved, {}
+            self._flushed_at = time()
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+        if pending:
+            counts = {}
+            for (banner_id, place_id, hour), count in pending.items():
+                counts[banner_id] = counts.get(banner_id, 0) + count
+            try:
+                write_views(counts)
+            except Exception:
+                self._restore(pending)
+                self._restore(reserved, reserved=True)
+                raise
+        stats = dict(reserved)
+        for key, count in pending.items():
+            stats[key] = stats.get(key, 0) + count
+        if stats and banner_settings.STATS:
+            try:
+                write_stats('views', stats)
+            except Exception:
+                # The banners are counted already, only the rollups are left to write
+                self._restore(stats, reserved=True)
+                raise
+        return stats
+
+    def _restore(self, counts, reserved=False):
+        with self._lock:
+            pending = self._reserved if reserved else self._pending
+            for key, count in counts.items():
+                pending[key] = pending.get(key, 0) + count
+
+    def _run(self):
+        try:
+            self.flush()
+        except Exception:
+            logger.exception('Failed to write buffered banner impressions')
+
+
+view_buffer = ViewBuffer(banner_settings.VIEWS_FLUSH_INTERVAL)
+atexit.register(view_buffer.flush)
+
+
+def count_views(views):
+    """
+    Counts one impression for each (banner, place) pair of views, place may
+    be a Place, a place id or None.
+
+    Banners without caps are counted with a single buffer write. Banners with
+    max_views or max_clicks reserve their impression in the counter backend
+    right away, so caps hold exactly under concurrency. Returns the indexes
+    of the views that could not be reserved because the banner is exhausted;
+    those impressions must not be shown.
+    """
+    with instrumentation.measure('counting'):
+        return _count_views(views)
+
+
+def _count_views(views):
+    backend = get_backend()
+    counts, reserved, rejected, exhausted, hour = {}, {}, [], [], get_hour()
+    campaigns = {}
+    for index, (banner, place) in enumerate(views):
+        key = (banner.pk, getattr(place, 'pk', place), hour)
+        if banner.max_views > 0 or banner.max_clicks > 0:
+            if not backend.reserve(banner):
+                snapshots.exhaust(banner.pk)
+                rejected.append(index)
+                exhausted.append(banner.pk)
+                continue
+            reserved[key] = reserved.get(key, 0) + 1
+        else:
+            counts[key] = counts.get(key, 0) + 1
+        if banner.campaign_id in campaign_ledger:
+            campaigns[banner.campaign_id] = campaigns.get(banner.campaign_id, 0) + 1
+        if snapshots.add_view(banner):
+            # The local count never exceeds the real one, so the banner is exhausted everywhere
+            exhausted.append(banner.pk)
+
+    if reserved:
+        view_buffer.add_many(reserved, reserved=True)
+    if counts:
+        view_buffer.add_many(counts)
+    deactivate(exhausted)
+    if campaigns:
+        count_campaigns('views', campaigns)
+    return rejected
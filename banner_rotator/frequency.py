@@ -0,0 +1,92 @@
+#-*- coding:utf-8 -*-
+
+from time import time
+
+from django.core.signing import Signer, BadSignature
+from django.utils.http import int_to_base36, base36_to_int
+
+from banner_rotator import settings as banner_settings
+
+
+# Keys kept in the cookie, further banners and campaigns are not capped for the visitor
+MAX_ENTRIES = 100
+
+_signer = []
+
+
+def get_signer():
+    if not _signer:
+        _signer.append(Signer(salt='banner_rotator.frequency'))
+    return _signer[0]
+
+
+def is_enabled():
+    return bool(banner_settings.FREQUENCY_CAP or banner_settings.CAMPAIGN_FREQUENCY_CAP)
+
+
+class VisitorFrequency(object):
+    """
+    Impressions per banner and campaign shown to one visitor since started_at.
+
+    Kept in a signed cookie as "started.b<banner>-<n>.c<campaign>-<n>", all
+    numbers in base 36, and reset when FREQUENCY_WINDOW has passed.
+    """
+
+    def __init__(self, started_at=None, counts=None):
+        self.started_at = started_at or int(time())
+        self.counts = counts or {}
+        self.changed = False
+
+    @classmethod
+    def from_cookie(cls, value):
+        if not value:
+            return cls()
+        try:
+            parts = get_signer().unsign(value).split('.')
+            started_at = base36_to_int(parts[0])
+            counts = dict((key, base36_to_int(count)) for key, count in
+                          (part.split('-') for part in parts[1:]))
+        except (BadSignature, ValueError):
+            return cls()
+        if time() - started_at >= banner_settings.FREQUENCY_WINDOW:
+            return cls()
+        return cls(started_at, counts)
+
+    def to_cookie(self):
+        parts = [int_to_base36(self.started_at)]
+        parts.extend('%s-%s' % (key, int_to_base36(count)) for key, count in sorted(self.counts.items()))
+        return get_signer().sign('.'.join(parts))
+
+    def max_age(self):
+        return max(0, int(self.started_at + banner_settings.FREQUENCY_WINDOW - time()))
+
+    def _keys(self, banner):
+        keys = []
+        if banner_settings.FREQUENCY_CAP:
+            keys.append(('b%s' % int_to_base36(banner.pk), banner_settings.FREQUENCY_CAP))
+        if banner_settings.CAMPAIGN_FREQUENCY_CAP and banner.campaign_id:
+            keys.append(('c%s' % int_to_base36(banner.campaign_id), banner_settings.CAMPAIGN_FREQUENCY_CAP))
+        return keys
+
+    def is_capped(self, banner):
+        for key, cap in self._keys(banner):
+            if self.counts.get(key, 0) >= cap:
+                return True
+        return False
+
+    def add(self, banner):
+        for key, cap in self._keys(banner):
+            if key in self.counts or len(self.counts) < MAX_ENTRIES:
+                self.counts[key] = self.counts.get(key, 0) + 1
+                self.changed = True
+
+
+def get_frequency(request):
+    """
+    The visitor's VisitorFrequency set by BannerRotatorFrequencyMiddleware, or None.
+    Marks the request as depending on the frequency cookie.
+    """
+    visitor = getattr(request, 'banner_frequency', None)
+    if visitor is not None:
+        request.banner_frequency_used = True
+    return visitor
@@ -0,0 +1,120 @@
+#-*- coding:utf-8 -*-
+
+import threading
+from contextlib import contextmanager
+from time import time
+
+from django.conf import settings
+from django.db import connection
+from django.dispatch import Signal
+
+
+# Sent at the end of every request measured by BannerRotatorStatsMiddleware
+request_measured = Signal(providing_args=['request', 'stats'])
+
+SECTIONS = ('selection', 'rendering', 'counting')
+CACHES = ('snapshot', 'place', 'fragment')
+
+_local = threading.local()
+_totals = {}
+_totals_lock = threading.Lock()
+
+
+def new_stats():
+    stats = {'slots': 0, 'queries': 0}
+    for section in SECTIONS:
+        stats['%s_seconds' % section] = 0.0
+    for cache in CACHES:
+        stats['%s_hits' % cache] = 0
+        stats['%s_misses' % cache] = 0
+    return stats
+
+
+def start():
+    _local.stats = new_stats()
+
+
+def finish():
+    """
+    Stops measuring the current thread and adds its stats to the process totals
+    """
+    stats = getattr(_local, 'stats', None)
+    _local.stats = None
+    if stats is not None:
+        with _totals_lock:
+            _totals['requests'] = _totals.get('requests', 0) + 1
+            for name, value in stats.items():
+                _totals[name] = _totals.get(name, 0) + value
+    return stats
+
+
+def totals():
+    with _totals_lock:
+        result = new_stats()
+        result['requests'] = 0
+        result.update(_totals)
+    return result
+
+
+def incr(name, count=1):
+    stats = getattr(_local, 'stats', None)
+    if stats is not None:
+        stats[name] += count
+
+
+def cache_hit(cache, hit):
+    incr('%s_%s' % (cache, 'hits' if hit else 'misses'))
+
+
+@contextmanager
+def measure(section):
+    """
+    Adds the time spent and the queries run in the block to the current request.
+    Time spent in a nested block is only counted for the inner section.
+    """
+    stats = getattr(_local, 'stats', None)
+    if stats is None:
+        yield
+        return
+
+    sections = _local.__dict__.setdefault('sections', [])
+    if sections:
+        parent = sections[-1]
+        sections.append(section)
+        started = time()
+        try:
+            yield
+        finally:
+            elapsed = time() - started
+            stats['%s_seconds' % section] += elapsed
+            stats['%s_seconds' % parent] -= elapsed
+            sections.pop()
+        return
+
+    # Queries are only logged by the debug cursor, so it is switched on for the block
+    use_debug_cursor = connection.use_debug_cursor
+    connection.use_debug_cursor = True
+    queries = len(connection.queries)
+    sections.append(section)
+    started = time()
+    try:
+        yield
+    finally:
+        stats['%s_seconds' % section] += time() - started
+        stats['queries'] += len(connection.queries) - queries
+        if not settings.DEBUG:
+            del connection.queries[queries:]
+        connection.use_debug_cursor = use_debug_cursor
+        sections.pop()
+
+
+def prometheus(values):
+    """
+    Formats totals() in the Prometheus text exposition format
+    """
+    lines = []
+    for name in sorted(values):
+        metric = 'banner_rotator_%s_total' % name
+        lines.append('# TYPE %s counter' % metric)
+        lines.append('%s %s' % (metric, values[name]))
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,101 @@
+#-*- coding:utf-8 -*-
+
+import datetime
+import gzip
+import json
+import os
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.db.models import Count
+
+from banner_rotator.counters import get_hour, write_stats
+from banner_rotator.models import BannerStat, Click
+
+
+FIELDS = ('id', 'banner', 'place', 'user', 'datetime', 'ip', 'user_agent', 'referrer')
+
+
+class Command(BaseCommand):
+    help = ('Moves clicks older than --days out of the Click table into gzipped JSON lines files, '
+            'one per month, after rebuilding the hourly BannerStat rollups of their hours.')
+
+    option_list = BaseCommand.option_list + (
+        make_option('--days', type='int', default=90,
+                    help='Keep the clicks of this many days in the Click table (default 90).'),
+        make_option('--directory',
+                    help='Directory of the banner-clicks-YYYY-MM.jsonl.gz archives.'),
+        make_option('--no-archive', action='store_true', default=False,
+                    help='Delete the old clicks without writing them anywhere.'),
+        make_option('--chunk-size', type='int', default=1000,
+                    help='Clicks moved per transaction (default 1000).'),
+    )
+
+    def handle(self, **options):
+        directory = options.get('directory')
+        if not directory and not options.get('no_archive'):
+            raise CommandError('Pass --directory to archive the clicks or --no-archive to only delete them.')
+        if directory and not os.path.isdir(directory):
+            raise CommandError('%s is not a directory' % directory)
+
+        cutoff = datetime.datetime.now() - datetime.timedelta(days=options['days'])
+        clicks = Click.objects.filter(datetime__lt=cutoff).order_by('id').values_list(*FIELDS)
+        moved, rolled_up = 0, set()
+        while True:
+            chunk = list(clicks[:options['chunk_size']])
+            if not chunk:
+                break
+            if directory:
+                self.archive(directory, chunk)
+            self.move(chunk, rolled_up)
+            moved += len(chunk)
+
+        if int(options.get('verbosity', 1)) > 0:
+            self.stdout.write('Moved %s clicks older than %s\n' % (moved, cutoff.date()))
+
+    def archive(self, directory, chunk):
+        """
+        Appends the chunk to the archive of each month, a crash before move()
+        may leave clicks in the archive that are archived again on the next run
+        """
+        months = {}
+        for row in chunk:
+            months.setdefault(row[4].strftime('%Y-%m'), []).append(row)
+        for month, rows in months.items():
+            archive = gzip.open(os.path.join(directory, 'banner-clicks-%s.jsonl.gz' % month), 'ab')
+            try:
+                for row in rows:
+                    values = dict(zip(FIELDS, row))
+                    values['datetime'] = values['datetime'].isoformat()
+                    archive.write((json.dumps(values) + '\n').encode('utf-8'))
+            finally:
+                archive.close()
+
+    def move(self, chunk, rolled_up):
+        """
+        Rebuilds the BannerStat clicks of the hours in the chunk and deletes it from Click in one transaction.
+
+        The rollup of a banner, place and hour is raised to the number of its
+        clicks still in the Click table, so hours that were counted only in
+        part when the clicks were recorded are completed, and hours whose
+        older clicks an earlier run has already archived are kept.
+        Each hour is rebuilt once per run, before any of its clicks is deleted.
+        """
+        keys = set((row[1], row[2], get_hour(row[4])) for row in chunk) - rolled_up
+        banner_ids = set(key[0] for key in keys)
+
+        with transaction.commit_on_success():
+            clicks = {}
+            for hour in set(key[2] for key in keys):
+                rows = Click.objects.filter(banner__in=banner_ids, datetime__gte=hour,
+                                            datetime__lt=hour + datetime.timedelta(hours=1))
+                for banner_id, place_id, count in rows.values_list('banner', 'place').annotate(Count('id')):
+                    clicks[(banner_id, place_id, hour)] = count
+            existing = dict(((banner_id, place_key or None, hour), count) for banner_id, place_key, hour, count in
+                            BannerStat.objects.filter(banner__in=banner_ids, hour__in=set(key[2] for key in keys))
+                            .values_list('banner', 'place_key', 'hour', 'clicks'))
+            write_stats('clicks', dict((key, clicks[key] - existing.get(key, 0)) for key in keys
+                                       if clicks.get(key, 0) > existing.get(key, 0)))
+            rolled_up.update(keys)
+            Click.objects.filter(pk__in=[row[0] for row in chunk]).delete()
@@ -0,0 +1,34 @@
+#-*- coding:utf-8 -*-
+
+from django.core.management.base import NoArgsCommand
+from django.db.models import F
+
+from banner_rotator.backends import COUNTER_FIELDS, get_backend
+from banner_rotator.models import Banner
+from banner_rotator.snapshot import snapshots
+
+
+class Command(NoArgsCommand):
+    help = 'Writes the views and click totals kept by the counter backend back to the Banner table.'
+
+    def handle_noargs(self, **options):
+        backend = get_backend()
+        if backend.writes_model:
+            return
+
+        updated = 0
+        for field in COUNTER_FIELDS:
+            current = dict(Banner.objects.values_list('pk', field))
+            totals = backend.get_many(field, list(current))
+            for banner_id, total in totals.items():
+                # Counters only grow, a lower total means the backend lost data
+                if total > (current[banner_id] or 0):
+                    updated += Banner.objects.filter(pk=banner_id).update(**{field: total})
+
+        capped = Banner.objects.filter(is_active=True, max_views__gt=0, views__gte=F('max_views')) | \
+            Banner.objects.filter(is_active=True, max_clicks__gt=0, click_count__gte=F('max_clicks'))
+        if capped.update(is_active=False):
+            snapshots.invalidate()
+
+        if int(options.get('verbosity', 1)) > 0:
+            self.stdout.write('Updated %s banner counters\n' % updated)
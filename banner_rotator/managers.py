@@ -1,45 +1,121 @@
 #-*- coding:utf-8 -*-
 
-from random import random
 import datetime
+
 from django.db import models
 
+from banner_rotator.counters import count_views
+from banner_rotator.sampling import AliasSampler
+from banner_rotator.snapshot import snapshots, places
+
 
 def pick(bias_list):
     """ Takes a list of 2-tuples [(item, weight)] using weight as the
         probability when calculating an item to choose
+
+        Kept for compatibility, build an AliasSampler once when choosing
+        from the same list repeatedly.
     """
     try:
-        # First, normalize weights to ensure we
-        # have a valid probability distribution
-        assert sum([w for i, w in bias_list]) == 1
-    except AssertionError:
-        norm_const = float(sum([w for i, w in bias_list]))
-        distribution = [(i, w / norm_const) for i, w in bias_list]
-    else:
-        distribution = bias_list
+        return AliasSampler(bias_list).choice()
+    except ValueError:
+        return None
 
-    number = random()
-    current = 0.0
 
-    # @link http://fr.w3support.net/index.php?db=so&id=479236
-    for choice, probability in distribution:
-        current += probability
-        if number <= current:
-            return choice
+class PlaceManager(models.Manager):
+
+    def get_cached(self, slug):
+        """
+        Like get(slug=slug) but answered from the place cache after the first call
+        """
+        place = places.get(self, slug)
+        if place is None:
+            raise self.model.DoesNotExist
+        return place
+
+    def in_bulk_cached(self, slugs):
+        """
+        Returns {slug: place} for the slugs that exist, answered from the place cache
+        """
+        return places.get_many(self, slugs)
 
 
 class BannerManager(models.Manager):
 
-    def biased_choice(self, place):
-                    
-        queryset = self.filter(models.Q(is_active=True) & models.Q(places=place) &
-                               ((models.Q(views__lt=models.F('max_views')) & models.Q(max_views__gt=0)) | models.Q(max_views__lt=1)) &
-                               ((models.Q(click_count__lt=models.F('max_clicks')) & models.Q(max_clicks__gt=0)) | models.Q(max_clicks__lt=1)) &
-                               models.Q(start_at__lte=datetime.datetime.today()) & models.Q(finish_at__gte=datetime.datetime.today()))
+    def biased_choice(self, place, frequency=None):
+        """
+        Weighted choice among the eligible banners of place, banners capped
+        for the visitor by frequency (a VisitorFrequency) are left out
+        """
+        capped = frequency.is_capped if frequency is not None and frequency.counts else None
+        banner = snapshots.get(self, getattr(place, 'pk', place)).choice(exclude=capped)
 
-        if not queryset.count():
+        if banner is None:
             raise self.model.DoesNotExist
 
-        normalizer = queryset.aggregate(normalizer=models.Sum('weight'))['normalizer']
-        return pick([(i, i.weight / float(normalizer)) for i in queryset])
+        return banner
+
+    def biased_choices(self, places, unique=None, exclude=(), frequency=None):
+        """
+        Picks a banner for each of places, returns a list with None where no
+        banner is available. unique='banner' or unique='campaign' keeps the same
+        banner or campaign from being picked for more than one place, or again
+        for the banners in exclude. Banners capped for the visitor by frequency
+        are left out.
+        """
+        now = datetime.datetime.today()
+        found = snapshots.get_many(self, [place.pk for place in places])
+
+        if unique == 'campaign':
+            key = lambda banner: ('campaign', banner.campaign_id) if banner.campaign_id else ('banner', banner.pk)
+        elif unique == 'banner':
+            key = lambda banner: banner.pk
+        else:
+            key = None
+
+        capped = frequency.is_capped if frequency is not None and frequency.counts else None
+        chosen, seen = [], set(key(banner) for banner in exclude) if key else set()
+
+        def excluded(banner):
+            if seen and key(banner) in seen:
+                return True
+            return capped is not None and capped(banner)
+
+        for place in places:
+            banner = found[place.pk].choice(now, exclude=excluded if seen or capped else None)
+            if banner is not None and key:
+                seen.add(key(banner))
+            chosen.append(banner)
+        return chosen
+
+    def serve(self, place, frequency=None):
+        """
+        biased_choice() that also counts the impression, for the visitor too
+        when frequency is given. Banners that were exhausted by other workers
+        since the snapshot was built are skipped.
+        """
+        while True:
+            banner = self.biased_choice(place, frequency)
+            if not count_views([(banner, place)]):
+                if frequency is not None:
+                    frequency.add(banner)
+                return banner
+
+    def serve_many(self, places, unique=None, frequency=None):
+        """
+        biased_choices() that also counts the impressions, see serve()
+        """
+        chosen = self.biased_choices(places, unique=unique, frequency=frequency)
+        pending = [i for i, banner in enumerate(chosen) if banner is not None]
+        while pending:
+            rejected = count_views([(chosen[i], places[i]) for i in pending])
+            pending = [pending[i] for i in rejected]
+            for i in pending:
+                others = [banner for j, banner in enumerate(chosen) if j != i and banner is not None]
+                chosen[i] = self.biased_choices([places[i]], unique=unique, exclude=others, frequency=frequency)[0]
+            pending = [i for i in pending if chosen[i] is not None]
+        if frequency is not None:
+            for banner in chosen:
+                if banner is not None:
+                    frequency.add(banner)
+        return chosen
@@ -0,0 +1,51 @@
+#-*- coding:utf-8 -*-
+
+from django.utils.cache import patch_vary_headers
+
+from banner_rotator import frequency
+from banner_rotator import instrumentation
+from banner_rotator import settings as banner_settings
+
+
+class BannerRotatorStatsMiddleware(object):
+    """
+    Measures banner slots, queries, timings and cache hits of every request.
+
+    The per-request dict is sent with the instrumentation.request_measured
+    signal and added to the process totals served by the banner_stats view.
+    """
+
+    def process_request(self, request):
+        instrumentation.start()
+
+    def process_response(self, request, response):
+        stats = instrumentation.finish()
+        if stats is not None:
+            instrumentation.request_measured.send(sender=self.__class__, request=request, stats=stats)
+        return response
+
+
+class BannerRotatorFrequencyMiddleware(object):
+    """
+    Loads the visitor's impression counts from the frequency cookie into
+    request.banner_frequency for the frequency caps, and stores them back
+    when banners were served. Costs no database or cache access.
+
+    Only responses that chose banners with the cookie get Vary: Cookie, so
+    other pages stay cacheable as a whole.
+    """
+
+    def process_request(self, request):
+        if frequency.is_enabled():
+            request.banner_frequency = frequency.VisitorFrequency.from_cookie(
+                request.COOKIES.get(banner_settings.FREQUENCY_COOKIE))
+
+    def process_response(self, request, response):
+        if getattr(request, 'banner_frequency_used', False):
+            # The banners served depend on the cookie, so caches must not share the response between visitors
+            patch_vary_headers(response, ('Cookie',))
+        visitor = getattr(request, 'banner_frequency', None)
+        if visitor is not None and visitor.changed:
+            response.set_cookie(banner_settings.FREQUENCY_COOKIE, visitor.to_cookie(),
+                                max_age=visitor.max_age(), httponly=True)
+        return response
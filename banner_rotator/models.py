@@ -8,10 +8,16 @@ from time import time
 
 from django.contrib.auth.models import User
 from django.db import models
+from django.db.models.signals import pre_save, post_save, post_delete, m2m_changed
+from django.core.urlresolvers import reverse
 from django.core.validators import MaxLengthValidator
 from django.utils.translation import ugettext_lazy as _
 
-from banner_rotator.managers import BannerManager
+from banner_rotator.click_queue import record_click
+from banner_rotator.counters import count_views
+from banner_rotator.managers import BannerManager, PlaceManager
+from banner_rotator.snapshot import invalidate_snapshots, invalidate_place_snapshot, remember_place_slug
+from banner_rotator.tokens import make_token
 
 
 def get_banner_upload_to(instance, filename):
@@ -29,6 +35,11 @@ class Campaign(models.Model):
     created_at = models.DateTimeField(_('Create at'), auto_now_add=True, help_text='')
     updated_at = models.DateTimeField(_('Update at'), auto_now=True, help_text='')
 
+    max_views = models.IntegerField(_('Max views'), default=0, help_text=_('For all banners, zero is unlimited.'))
+    max_clicks = models.IntegerField(_('Max clicks'), default=0, help_text=_('For all banners, zero is unlimited.'))
+    daily_max_views = models.IntegerField(_('Max views per day'), default=0, help_text='')
+    daily_max_clicks = models.IntegerField(_('Max clicks per day'), default=0, help_text='')
+
     class Meta:
         verbose_name = _('campaign')
         verbose_name_plural = _('campaigns')
@@ -36,6 +47,9 @@ class Campaign(models.Model):
     def __unicode__(self):
         return self.name
 
+    def has_caps(self):
+        return bool(self.max_views or self.max_clicks or self.daily_max_views or self.daily_max_clicks)
+
 
 class Place(models.Model):
     name = models.CharField(_('Name'), max_length=255, help_text='')
@@ -43,6 +57,8 @@ class Place(models.Model):
     width = models.SmallIntegerField(_('Width'), blank=True, null=True, default=None, help_text='')
     height = models.SmallIntegerField(_('Height'), blank=True, null=True, default=None, help_text='')
 
+    objects = PlaceManager()
+
     class Meta:
         unique_together = ('slug',)
         verbose_name = _('place')
@@ -92,6 +108,7 @@ class Banner(models.Model):
     created_at = models.DateTimeField(auto_now_add=True, help_text='')
     updated_at = models.DateTimeField(auto_now=True, help_text='')
 
+    # Migration 0013 adds an index on (is_active, finish_at) for loading the banners of a place
     start_at = models.DateTimeField(_('Start at'), blank=True, null=True, default=None, help_text='')
     finish_at = models.DateTimeField(_('Finish at'), blank=True, null=True, default=None, help_text='')
 
@@ -114,51 +131,89 @@ class Banner(models.Model):
     def is_swf(self):
         return self.file.name.lower().endswith("swf")
 
-    def view(self):
-        self.views += 1
-        if self.views >= self.max_views and self.is_active and self.max_views != 0:
-            self.is_active = False
-        self.save()
+    # view() and click() leave the instance alone, it may be shared by the place snapshots of all threads
+
+    def view(self, place=None):
+        count_views([(self, place)])
         return ''
 
-    def click(self, request):
-        click = {
-            'banner': self,
-            'ip': request.META.get('REMOTE_ADDR'),
-            'user_agent': request.META.get('HTTP_USER_AGENT'),
-            'referrer': request.META.get('HTTP_REFERER'),
-        }
-
-        if request.user.is_authenticated():
-            click['user'] = request.user
-        self.click_count += 1
-        if self.click_count >= self.max_clicks and self.is_active and self.max_clicks != 0:
-            self.is_active = False
-        self.save()
-        return Click.objects.create(**click)
-
-    @models.permalink
+    def click(self, request, place=None):
+        return record_click(request, self.pk, place and place.pk)
+
     def get_absolute_url(self):
-        return 'banner_click', (), {'banner_id': self.pk}
+        """
+        Signed click URL for an impression of the banner outside any place
+        """
+        return reverse('banner_token_click', kwargs={'token': make_token(self.pk)})
 
     def admin_clicks_str(self):
         if self.max_clicks:
-            return '%s / %s' % (self.clicks, self.max_clicks)
-        return '%s' % self.clicks
+            return '%s / %s' % (self.click_count or 0, self.max_clicks)
+        return '%s' % (self.click_count or 0)
     admin_clicks_str.short_description = _('Clicks')
+    admin_clicks_str.admin_order_field = 'click_count'
 
     def admin_views_str(self):
         if self.max_views:
             return '%s / %s' % (self.views, self.max_views)
         return '%s' % self.views
     admin_views_str.short_description = _('Views')
+    admin_views_str.admin_order_field = 'views'
+
+    def admin_ctr_str(self):
+        return '%.2f%%' % (100.0 * (self.click_count or 0) / self.views if self.views else 0)
+    admin_ctr_str.short_description = _('CTR')
+    admin_ctr_str.admin_order_field = 'click_through_rate'
+
+    def admin_places_str(self):
+        # Reads the places prefetched by BannerAdmin.queryset()
+        return ', '.join(place.name for place in self.places.all())
+    admin_places_str.short_description = _('Places')
 
 
 class Click(models.Model):
+    # Migration 0012 adds an index on (banner, datetime) for the admin clicks log
     banner = models.ForeignKey(Banner, related_name="clicks", help_text='')
+    place = models.ForeignKey(Place, null=True, blank=True, default=None, related_name="clicks", help_text='')
     user = models.ForeignKey(User, null=True, blank=True, related_name="banner_clicks", help_text='')
     datetime = models.DateTimeField("Clicked at", auto_now_add=True, help_text='')
     ip = models.IPAddressField(null=True, blank=True, help_text='')
     user_agent = models.TextField(validators=[MaxLengthValidator(1000)], null=True, blank=True, 
                                 help_text='')
     referrer = models.URLField(null=True, blank=True, help_text='')
+    # From the signed click URL, ties the click to the impression it was made on
+    impression_id = models.CharField(max_length=12, null=True, blank=True, editable=False, help_text='')
+
+
+class BannerStat(models.Model):
+    banner = models.ForeignKey(Banner, related_name="stats", help_text='')
+    place = models.ForeignKey(Place, null=True, blank=True, default=None, related_name="stats", help_text='')
+    # place_id or 0 for views and clicks without a place: NULLs are distinct in a unique index
+    place_key = models.IntegerField(default=0, editable=False, help_text='')
+    hour = models.DateTimeField(_('Hour'), db_index=True, help_text='')
+    views = models.PositiveIntegerField(_('Views'), default=0, help_text='')
+    clicks = models.PositiveIntegerField(_('Clicks'), default=0, help_text='')
+
+    class Meta:
+        unique_together = ('banner', 'place_key', 'hour')
+        verbose_name = _('hourly statistics')
+        verbose_name_plural = _('hourly statistics')
+
+    def __unicode__(self):
+        return u'%s, %s' % (self.banner, self.hour)
+
+    def save(self, *args, **kwargs):
+        self.place_key = self.place_id or 0
+        super(BannerStat, self).save(*args, **kwargs)
+
+    def ctr(self):
+        return float(self.clicks) / self.views if self.views else 0.0
+
+
+post_save.connect(invalidate_snapshots, sender=Campaign)
+post_save.connect(invalidate_snapshots, sender=Banner)
+post_delete.connect(invalidate_snapshots, sender=Banner)
+m2m_changed.connect(invalidate_snapshots, sender=Banner.places.through)
+pre_save.connect(remember_place_slug, sender=Place)
+post_save.connect(invalidate_place_snapshot, sender=Place)
+post_delete.connect(invalidate_place_snapshot, sender=Place)
@@ -0,0 +1,125 @@
+#-*- coding:utf-8 -*-
+
+import threading
+from math import sqrt
+from time import time
+
+from banner_rotator import settings as banner_settings
+from banner_rotator.backends import get_backend
+
+
+MIN_FACTOR = 0.01
+MAX_FACTOR = 100.0
+
+
+def is_paced(banner):
+    return bool(banner_settings.PACING and banner.max_views > 0 and banner.start_at and banner.finish_at)
+
+
+def seconds(delta):
+    return delta.days * 86400 + delta.seconds + delta.microseconds / 1000000.0
+
+
+class Pacer(object):
+    """
+    Multiplier for the weight of one banner, steering its delivery rate
+    towards the even rate that spends the remaining max_views by finish_at.
+
+    It is adjusted once per PACING_INTERVAL from the banner's view total in
+    the counter backend, which counts the views of all places and processes,
+    so choosing a banner costs one multiplication.
+    """
+
+    def __init__(self, banner, now):
+        self.factor = 1.0
+        self.weighed_at = time()
+        self.views = banner.views
+        self.updated_at = now
+        self.max_views, self.finish_at = banner.max_views, banner.finish_at
+
+    def update(self, views, now):
+        elapsed = seconds(now - self.updated_at)
+        if elapsed <= 0:
+            return self.factor
+
+        remaining_time = seconds(self.finish_at - now)
+        remaining_views = self.max_views - views
+        if remaining_time > 0 and remaining_views > 0:
+            target = remaining_views / remaining_time
+            observed = (views - self.views) / elapsed
+            if observed > 0:
+                # Square root damps the correction, delivery also depends on the other banners
+                self.factor *= sqrt(target / observed)
+            else:
+                self.factor *= 2
+            self.factor = min(MAX_FACTOR, max(MIN_FACTOR, self.factor))
+
+        self.views, self.updated_at = views, now
+        return self.factor
+
+
+# banner_id -> Pacer for the whole process, shared by the snapshots of all places
+_pacers = {}
+_state = {'updated_at': time(), 'generation': 0}
+_lock = threading.Lock()
+
+
+def get_weight(banner, now):
+    """
+    Weight of banner for the sampler, scaled by its pacer when it is paced
+    """
+    if not is_paced(banner):
+        return banner.weight
+    pacer = _pacers.get(banner.pk)
+    if pacer is None:
+        pacer = _pacers.setdefault(banner.pk, Pacer(banner, now))
+    pacer.max_views, pacer.finish_at = banner.max_views, banner.finish_at
+    pacer.weighed_at = time()
+    return banner.weight * pacer.factor
+
+
+def is_due():
+    """
+    True if the next refresh() reads the counter backend
+    """
+    return bool(banner_settings.PACING) and time() - _state['updated_at'] >= banner_settings.PACING_INTERVAL
+
+
+def refresh(now):
+    """
+    Adjusts all pacers once per PACING_INTERVAL and returns the pacing
+    generation; samplers built in an older generation have stale weights.
+
+    Only the thread that takes the lock reads the backend, the others keep
+    choosing with the current weights meanwhile. Pacers of banners that no
+    snapshot has weighed for a while (finished, removed from their places,
+    places no longer served) are dropped.
+    """
+    if time() - _state['updated_at'] < banner_settings.PACING_INTERVAL:
+        return _state['generation']
+    if not _lock.acquire(False):
+        return _state['generation']
+    try:
+        if time() - _state['updated_at'] < banner_settings.PACING_INTERVAL:
+            return _state['generation']
+        _state['updated_at'] = time()
+        # Serving places rebuild their samplers, weighing their banners, once per generation
+        horizon = _state['updated_at'] - max(banner_settings.SNAPSHOT_TIMEOUT, 2 * banner_settings.PACING_INTERVAL)
+        for banner_id, pacer in list(_pacers.items()):
+            if pacer.weighed_at < horizon:
+                del _pacers[banner_id]
+        if _pacers:
+            totals = get_backend().get_many('views', list(_pacers))
+            for banner_id, pacer in list(_pacers.items()):
+                if banner_id in totals:
+                    pacer.update(totals[banner_id], now)
+        _state['generation'] += 1
+        return _state['generation']
+    finally:
+        _lock.release()
+
+
+def reset():
+    with _lock:
+        _pacers.clear()
+        _state['updated_at'] = time()
@@ -0,0 +1,49 @@
+#-*- coding:utf-8 -*-
+
+from random import random
+
+
+class AliasSampler(object):
+    """
+    Weighted random choice over a fixed list of 2-tuples [(item, weight)].
+
+    Uses Vose's alias method: the table is built once in O(n) and every
+    choice afterwards takes constant time and allocates nothing.
+    Items with a weight of zero or less are never chosen.
+    """
+
+    def __init__(self, bias_list):
+        bias_list = [(item, weight) for item, weight in bias_list if weight > 0]
+        if not bias_list:
+            raise ValueError('AliasSampler needs at least one item with a positive weight')
+
+        count = len(bias_list)
+        total = float(sum([weight for item, weight in bias_list]))
+        scaled = [weight * count / total for item, weight in bias_list]
+
+        self.items = [item for item, weight in bias_list]
+        self._count = count
+        self._probability = [1.0] * count
+        self._alias = list(range(count))
+
+        small = [i for i, p in enumerate(scaled) if p < 1.0]
+        large = [i for i, p in enumerate(scaled) if p >= 1.0]
+        while small and large:
+            less, more = small.pop(), large.pop()
+            self._probability[less] = scaled[less]
+            self._alias[less] = more
+            scaled[more] = scaled[more] + scaled[less] - 1.0
+            if scaled[more] < 1.0:
+                small.append(more)
+            else:
+                large.append(more)
+        # Whatever is left over is 1.0 up to rounding errors and keeps the defaults
+
+    def __len__(self):
+        return self._count
+
+    def choice(self):
+        i = int(random() * self._count)
+        if random() < self._probability[i]:
+            return self.items[i]
+        return self.items[self._alias[i]]
@@ -0,0 +1,75 @@
+#-*- coding:utf-8 -*-
+
+from django.conf import settings
+
+
+# Seconds a per-place snapshot of eligible banners is reused before it is
+# rebuilt from the database. Zero disables the snapshot.
+SNAPSHOT_TIMEOUT = getattr(settings, 'BANNER_ROTATOR_SNAPSHOT_TIMEOUT', 60)
+
+# Impressions are buffered in memory and written to the database at most once
+# per this many seconds. Zero writes every impression immediately: an UPDATE
+# and a SELECT of the banner and a BannerStat write per impression.
+VIEWS_FLUSH_INTERVAL = getattr(settings, 'BANNER_ROTATOR_VIEWS_FLUSH_INTERVAL', 0)
+
+# Click records are queued in memory and inserted in batches by a background
+# thread instead of being written before the redirect.
+CLICKS_ASYNC = getattr(settings, 'BANNER_ROTATOR_CLICKS_ASYNC', False)
+CLICKS_QUEUE_SIZE = getattr(settings, 'BANNER_ROTATOR_CLICKS_QUEUE_SIZE', 10000)
+CLICKS_BATCH_SIZE = getattr(settings, 'BANNER_ROTATOR_CLICKS_BATCH_SIZE', 500)
+# What to do with a click when the queue is full: 'sync' writes it right away, 'drop' discards it.
+CLICKS_QUEUE_FULL = getattr(settings, 'BANNER_ROTATOR_CLICKS_QUEUE_FULL', 'sync')
+
+# Seconds a place looked up by slug is kept in process memory.
+PLACE_CACHE_TIMEOUT = getattr(settings, 'BANNER_ROTATOR_PLACE_CACHE_TIMEOUT', 300)
+# Optional Django cache alias shared by all processes as a second tier for place lookups.
+PLACE_CACHE_BACKEND = getattr(settings, 'BANNER_ROTATOR_PLACE_CACHE_BACKEND', None)
+
+# Number of rendered place.html fragments kept in process memory. Zero disables the cache.
+FRAGMENT_CACHE_SIZE = getattr(settings, 'BANNER_ROTATOR_FRAGMENT_CACHE_SIZE', 1000)
+
+# Where views and click_count totals are kept: DatabaseCounterBackend,
+# CacheCounterBackend or RedisCounterBackend from banner_rotator.backends.
+COUNTER_BACKEND = getattr(settings, 'BANNER_ROTATOR_COUNTER_BACKEND',
+                          'banner_rotator.backends.DatabaseCounterBackend')
+# Keyword arguments for the counter backend, e.g. {'url': 'redis://localhost:6379/0'}.
+COUNTER_OPTIONS = getattr(settings, 'BANNER_ROTATOR_COUNTER_OPTIONS', {})
+
+# Keep hourly views/clicks rollups per banner and place in BannerStat.
+STATS = getattr(settings, 'BANNER_ROTATOR_STATS', True)
+
+# Seconds after the impression during which a signed click URL is counted.
+CLICK_TOKEN_MAX_AGE = getattr(settings, 'BANNER_ROTATOR_CLICK_TOKEN_MAX_AGE', 24 * 3600)
+
+# Count clicks on the old unsigned click/<id>/ URLs too. They always redirect,
+# but anybody can replay them. Deprecated: the default becomes False in the
+# next release, set it to False once no template links to banner_click.
+LEGACY_CLICKS = getattr(settings, 'BANNER_ROTATOR_LEGACY_CLICKS', True)
+
+# Spread max_views evenly between start_at and finish_at by adjusting the
+# weight of such banners every PACING_INTERVAL seconds.
+PACING = getattr(settings, 'BANNER_ROTATOR_PACING', False)
+PACING_INTERVAL = getattr(settings, 'BANNER_ROTATOR_PACING_INTERVAL', 60)
+
+# Threads running the database work of the awaitable functions in banner_rotator.aio,
+# each keeps its own database connection.
+ASYNC_THREADS = getattr(settings, 'BANNER_ROTATOR_ASYNC_THREADS', 10)
+
+# Repeated clicks on the same banner from the same IP address and user agent
+# are dropped for one to two times this many seconds, zero records every click.
+# Up to CLICK_DEDUP_CAPACITY clicks per window are remembered in a Bloom filter.
+CLICK_DEDUP_WINDOW = getattr(settings, 'BANNER_ROTATOR_CLICK_DEDUP_WINDOW', 3600)
+CLICK_DEDUP_CAPACITY = getattr(settings, 'BANNER_ROTATOR_CLICK_DEDUP_CAPACITY', 100000)
+
+# Clicks from user agents matching this regular expression (case-insensitive) are not recorded.
+CLICK_BOT_USER_AGENTS = getattr(settings, 'BANNER_ROTATOR_CLICK_BOT_USER_AGENTS',
+                                r'bot\b|crawl|spider|slurp|mediapartners|facebookexternalhit|bingpreview'
+                                r'|headless|phantomjs|python-requests|python-urllib|curl/|wget/|libwww|java/')
+
+# Impressions of one banner (FREQUENCY_CAP) and of the banners of one campaign
+# (CAMPAIGN_FREQUENCY_CAP) per visitor within FREQUENCY_WINDOW seconds, zero is
+# unlimited. Counted in a signed cookie by BannerRotatorFrequencyMiddleware.
+FREQUENCY_CAP = getattr(settings, 'BANNER_ROTATOR_FREQUENCY_CAP', 0)
+CAMPAIGN_FREQUENCY_CAP = getattr(settings, 'BANNER_ROTATOR_CAMPAIGN_FREQUENCY_CAP', 0)
+FREQUENCY_WINDOW = getattr(settings, 'BANNER_ROTATOR_FREQUENCY_WINDOW', 24 * 3600)
+FREQUENCY_COOKIE = getattr(settings, 'BANNER_ROTATOR_FREQUENCY_COOKIE', 'banner_rotator_frequency')
@@ -0,0 +1,488 @@
+#-*- coding:utf-8 -*-
+
+import datetime
+import threading
+from collections import namedtuple
+from time import time
+
+from django.db.models import Q
+
+from banner_rotator import instrumentation
+from banner_rotator import pacing
+from banner_rotator import settings as banner_settings
+from banner_rotator.backends import get_backend
+from banner_rotator.sampling import AliasSampler
+
+
+def is_eligible(banner, now):
+    """
+    In-memory equivalent of the filter biased_choice used to run in the database,
+    with the views and clicks counted by this process since banner was loaded
+    """
+    if not banner.is_active or snapshots.is_exhausted(banner.pk):
+        return False
+    if banner.max_views > 0 and snapshots.total(banner, 'views') >= banner.max_views:
+        return False
+    if banner.max_clicks > 0 and snapshots.total(banner, 'click_count') >= banner.max_clicks:
+        return False
+    if banner.start_at is not None and banner.start_at > now:
+        return False
+    if banner.finish_at is not None and banner.finish_at < now:
+        return False
+    if banner.campaign_id and campaign_ledger.is_exhausted(banner.campaign_id, now.date()):
+        return False
+    return True
+
+
+def next_boundary(banners, now):
+    """
+    Earliest start_at or finish_at after now among banners, None if there is none.
+    Until then is_eligible() can only change because of caps or deactivation.
+    """
+    instants = [banner.start_at for banner in banners if banner.start_at is not None and banner.start_at > now]
+    instants.extend(banner.finish_at for banner in banners if banner.finish_at is not None and banner.finish_at >= now)
+    return min(instants) if instants else None
+
+
+# Sampler of a snapshot without eligible banners until its next boundary
+EMPTY = object()
+
+
+class PlaceSnapshot(object):
+    """
+    Banners attached to a place, loaded once and filtered in memory on every choice
+    """
+
+    def __init__(self, place_id, banners):
+        self.place_id = place_id
+        self.banners = tuple(banners)
+        self.created_at = time()
+        self._sampler = None
+        self._boundary = None
+        self._day = None
+        self._pacing = None
+
+    def is_expired(self):
+        return time() - self.created_at >= banner_settings.SNAPSHOT_TIMEOUT
+
+    def eligible(self, now=None):
+        now = now or datetime.datetime.today()
+        return [banner for banner in self.banners if is_eligible(banner, now)]
+
+    def choice(self, now=None, exclude=None):
+        """
+        Weighted choice among the eligible banners, None if there is none.
+        Banners for which exclude(banner) is true are never chosen.
+
+        The sampler is rebuilt when a banner starts or finishes (the next
+        boundary of the place) and when it returns a banner that has dropped
+        out (cap reached, deactivated) since it was built.
+        """
+        now = now or datetime.datetime.today()
+        sampler = self._sampler
+        generation = pacing.refresh(now) if banner_settings.PACING else None
+        if generation != self._pacing:
+            # Weights of paced banners changed, the sampler has to be rebuilt
+            sampler = None
+        if self._boundary is not None and now >= self._boundary or now.date() != self._day:
+            # Daily campaign caps start over at midnight
+            sampler = None
+        if sampler is EMPTY:
+            return None
+        if sampler is not None:
+            banner = sampler.choice()
+            if is_eligible(banner, now):
+                if exclude is None or not exclude(banner):
+                    return banner
+            else:
+                sampler = None
+
+        if sampler is None:
+            self._boundary = next_boundary(self.banners, now)
+            self._day = now.date()
+            self._pacing = generation
+            try:
+                sampler = AliasSampler([(banner, pacing.get_weight(banner, now)) for banner in self.eligible(now)])
+            except ValueError:
+                self._sampler = EMPTY
+                return None
+            self._sampler = sampler
+        if exclude is None:
+            return sampler.choice()
+
+        # Exclusions are rare and per call, so they get a throwaway sampler
+        try:
+            return AliasSampler([(banner, pacing.get_weight(banner, now)) for banner in sampler.items
+                                 if is_eligible(banner, now) and not exclude(banner)]).choice()
+        except ValueError:
+            return None
+
+
+class SnapshotRegistry(object):
+    """
+    Process-local place_id -> PlaceSnapshot map.
+
+    The banners of the snapshots are shared by all threads and never changed
+    once published. The views and clicks counted since they were loaded, and
+    the banners found exhausted meanwhile, are kept here under the lock.
+    """
+
+    def __init__(self):
+        self._snapshots = {}
+        self._totals = {'views': {}, 'click_count': {}}
+        self._exhausted = set()
+        self._generation = 0
+        self._lock = threading.Lock()
+
+    def get(self, manager, place_id):
+        return self.get_many(manager, [place_id])[place_id]
+
+    def is_loaded(self, place_id):
+        """
+        True if get() would answer from memory without a query
+        """
+        snapshot = self._snapshots.get(place_id)
+        return snapshot is not None and not snapshot.is_expired()
+
+    def get_many(self, manager, place_ids):
+        """
+        Returns {place_id: PlaceSnapshot}, loading all missing snapshots with one query
+        """
+        found, missing = {}, []
+        for place_id in place_ids:
+            snapshot = self._snapshots.get(place_id)
+            if snapshot is None or snapshot.is_expired():
+                missing.append(place_id)
+            else:
+                found[place_id] = snapshot
+            instrumentation.cache_hit('snapshot', place_id in found)
+        if missing:
+            found.update(self.build(manager, missing))
+        return found
+
+    def build(self, manager, place_ids):
+        generation = self._generation
+        banners = dict((place_id, []) for place_id in place_ids)
+        # Finished banners never become eligible again without being saved, which drops the snapshot
+        links = manager.model.places.through.objects.filter(
+            Q(banner__finish_at__isnull=True) | Q(banner__finish_at__gte=datetime.datetime.today()),
+            place__in=place_ids, banner__is_active=True)
+        for link in links.select_related('banner__campaign'):
+            banners[link.place_id].append(link.banner)
+        loaded = sum(banners.values(), [])
+        get_backend().load(loaded)
+        campaign_ledger.load([banner.campaign for banner in loaded if banner.campaign_id], datetime.date.today())
+        built = dict((place_id, PlaceSnapshot(place_id, banners[place_id])) for place_id in place_ids)
+
+        with self._lock:
+            # Do not publish snapshots that were invalidated while they were being loaded
+            if generation == self._generation:
+                self._snapshots.update(built)
+                for banner in loaded:
+                    for field, totals in self._totals.items():
+                        totals[banner.pk] = getattr(banner, field) or 0
+                    self._exhausted.discard(banner.pk)
+        return built
+
+    def total(self, banner, field):
+        """
+        views or click_count of banner, counting what this process added since it was loaded
+        """
+        return max(self._totals[field].get(banner.pk, 0), getattr(banner, field) or 0)
+
+    def add_view(self, banner):
+        """
+        Counts one view of banner, returns True if it just reached max_views
+        """
+        with self._lock:
+            views = self._totals['views'][banner.pk] = self.total(banner, 'views') + 1
+            if 0 < banner.max_views <= views and banner.pk not in self._exhausted:
+                self._exhausted.add(banner.pk)
+                return True
+        return False
+
+    def exhaust(self, banner_id):
+        """
+        Leaves banner_id out of the choices until its snapshots are rebuilt
+        """
+        with self._lock:
+            self._exhausted.add(banner_id)
+
+    def is_exhausted(self, banner_id):
+        return banner_id in self._exhausted
+
+    def update_counters(self, field, totals):
+        """
+        Records {banner_id: total} for the banners held by the snapshots,
+        returns {banner_id: banner} for the banners found
+        """
+        found = {}
+        for snapshot in list(self._snapshots.values()):
+            for banner in snapshot.banners:
+                if banner.pk in totals:
+                    found[banner.pk] = banner
+        with self._lock:
+            for banner_id in found:
+                self._totals[field][banner_id] = totals[banner_id] or 0
+        return found
+
+    def invalidate(self, place_id=None):
+        with self._lock:
+            self._generation += 1
+            if place_id is None:
+                self._snapshots.clear()
+                for totals in self._totals.values():
+                    totals.clear()
+                self._exhausted.clear()
+            else:
+                self._snapshots.pop(place_id, None)
+
+
+snapshots = SnapshotRegistry()
+
+
+class CampaignBudget(object):
+    """
+    Caps of a campaign and the views and clicks counted against them
+    """
+
+    def __init__(self, campaign, views, clicks, day, day_views, day_clicks):
+        self.max_views, self.max_clicks = campaign.max_views, campaign.max_clicks
+        self.daily_max_views, self.daily_max_clicks = campaign.daily_max_views, campaign.daily_max_clicks
+        self.views, self.clicks = views, clicks
+        self.day, self.day_views, self.day_clicks = day, day_views, day_clicks
+
+    def add(self, field, count, day):
+        if day != self.day:
+            self.day, self.day_views, self.day_clicks = day, 0, 0
+        if field == 'views':
+            self.views += count
+            self.day_views += count
+        else:
+            self.clicks += count
+            self.day_clicks += count
+
+    def is_spent(self):
+        """
+        True once a total cap is reached, the campaign does not come back
+        """
+        return (0 < self.max_views <= self.views) or (0 < self.max_clicks <= self.clicks)
+
+    def is_exhausted(self, day):
+        if self.is_spent():
+            return True
+        if day != self.day:
+            return False
+        return (0 < self.daily_max_views <= self.day_views) or (0 < self.daily_max_clicks <= self.day_clicks)
+
+
+class CampaignLedger(object):
+    """
+    Process-local campaign_id -> CampaignBudget for the campaigns with caps.
+
+    Budgets are loaded with the place snapshots: totals from the Banner
+    counters, today's counts from the BannerStat rollups. In between they
+    are counted along with the banners, so checking a campaign is a dict
+    lookup. Other processes' counts are picked up when snapshots are rebuilt.
+    """
+
+    def __init__(self):
+        self._budgets = {}
+        self._lock = threading.Lock()
+
+    def __contains__(self, campaign_id):
+        return campaign_id in self._budgets
+
+    def __len__(self):
+        return len(self._budgets)
+
+    def load(self, campaigns, today):
+        from django.db.models import Sum
+        from banner_rotator.models import Banner, BannerStat
+
+        capped = dict((campaign.pk, campaign) for campaign in campaigns if campaign.has_caps())
+        with self._lock:
+            for campaign in campaigns:
+                if campaign.pk not in capped:
+                    self._budgets.pop(campaign.pk, None)
+        if not capped:
+            return
+
+        # Aggregates are named, the order of positional ones in values_list() is not guaranteed
+        totals = dict((row['campaign'], (row['views_sum'], row['clicks_sum'])) for row in
+                      Banner.objects.filter(campaign__in=list(capped)).values('campaign')
+                      .annotate(views_sum=Sum('views'), clicks_sum=Sum('click_count')))
+        daily = {}
+        if any(campaign.daily_max_views or campaign.daily_max_clicks for campaign in capped.values()):
+            stats = BannerStat.objects.filter(banner__campaign__in=list(capped),
+                                              hour__gte=datetime.datetime.combine(today, datetime.time()))
+            daily = dict((row['banner__campaign'], (row['views_sum'], row['clicks_sum'])) for row in
+                         stats.values('banner__campaign').annotate(views_sum=Sum('views'), clicks_sum=Sum('clicks')))
+
+        with self._lock:
+            for campaign_id, campaign in capped.items():
+                views, clicks = totals.get(campaign_id, (0, 0))
+                day_views, day_clicks = daily.get(campaign_id, (0, 0))
+                self._budgets[campaign_id] = CampaignBudget(campaign, views or 0, clicks or 0,
+                                                            today, day_views or 0, day_clicks or 0)
+
+    def add(self, field, counts, today):
+        """
+        Adds {campaign_id: n} to field ('views' or 'click_count'), returns the
+        ids of the campaigns that reached a total cap with it
+        """
+        spent = []
+        with self._lock:
+            for campaign_id, count in counts.items():
+                budget = self._budgets.get(campaign_id)
+                if budget is not None and not budget.is_spent():
+                    budget.add(field, count, today)
+                    if budget.is_spent():
+                        spent.append(campaign_id)
+        return spent
+
+    def is_exhausted(self, campaign_id, today):
+        budget = self._budgets.get(campaign_id)
+        return budget is not None and budget.is_exhausted(today)
+
+    def invalidate(self):
+        with self._lock:
+            self._budgets.clear()
+
+
+campaign_ledger = CampaignLedger()
+
+
+class PlaceCache(object):
+    """
+    Process-local slug -> Place map, optionally backed by a shared Django cache.
+    Unknown slugs are cached too (as None) so a typo in a template costs no queries.
+    """
+
+    def __init__(self, timeout, backend=None):
+        self.timeout = timeout
+        self.backend = backend
+        self._places = {}
+
+    def _key(self, slug):
+        return 'banner_rotator:place:%s' % slug
+
+    def _backend(self):
+        if self.backend is None:
+            return None
+        from django.core.cache import get_cache
+        return get_cache(self.backend)
+
+    def get(self, manager, slug):
+        return self.get_many(manager, [slug]).get(slug)
+
+    def get_many(self, manager, slugs):
+        """
+        Returns {slug: place} for the slugs that exist, with at most one query
+        """
+        found, missing, now = {}, [], time()
+        for slug in slugs:
+            cached = self._places.get(slug)
+            if cached is not None and cached[1] > now:
+                found[slug] = cached[0]
+            else:
+                missing.append(slug)
+            instrumentation.cache_hit('place', slug in found)
+
+        backend = self._backend()
+        if missing and backend is not None:
+            shared = backend.get_many([self._key(slug) for slug in missing])
+            for slug in list(missing):
+                if self._key(slug) in shared:
+                    found[slug] = shared[self._key(slug)]
+                    self._places[slug] = (found[slug], now + self.timeout)
+                    missing.remove(slug)
+
+        if missing:
+            loaded = dict((place.slug, place) for place in manager.filter(slug__in=missing))
+            for slug in missing:
+                found[slug] = loaded.get(slug)
+                self._places[slug] = (found[slug], now + self.timeout)
+            if backend is not None:
+                backend.set_many(dict((self._key(slug), found[slug]) for slug in missing), self.timeout)
+
+        return dict((slug, place) for slug, place in found.items() if place is not None)
+
+    def invalidate(self, *slugs):
+        """
+        Clears the process cache and drops slugs from the shared one
+        """
+        self._places.clear()
+        backend = self._backend()
+        if slugs and backend is not None:
+            backend.delete_many([self._key(slug) for slug in slugs])
+
+
+places = PlaceCache(banner_settings.PLACE_CACHE_TIMEOUT, banner_settings.PLACE_CACHE_BACKEND)
+
+
+ClickTarget = namedtuple('ClickTarget', 'url max_views max_clicks place_ids')
+
+
+class ClickTargets(object):
+    """
+    Process-local banner_id -> ClickTarget map, so that the click redirect
+    does not have to load the banner
+    """
+
+    def __init__(self, timeout):
+        self.timeout = timeout
+        self._targets = {}
+
+    def get(self, manager, banner_id):
+        cached = self._targets.get(banner_id)
+        if cached is not None and cached[1] > time():
+            return cached[0]
+
+        rows = manager.filter(pk=banner_id).values_list('url', 'max_views', 'max_clicks')
+        if not rows:
+            return None
+        place_ids = manager.model.places.through.objects.filter(banner=banner_id).values_list('place_id', flat=True)
+        target = ClickTarget(*rows[0], place_ids=frozenset(place_ids))
+        self._targets[banner_id] = (target, time() + self.timeout)
+        return target
+
+    def caps(self, cap_field, banner_ids):
+        """
+        Returns {banner_id: cap} for the banners in the map
+        """
+        found = {}
+        for banner_id in banner_ids:
+            cached = self._targets.get(banner_id)
+            if cached is not None:
+                found[banner_id] = getattr(cached[0], cap_field)
+        return found
+
+    def invalidate(self):
+        self._targets.clear()
+
+
+click_targets = ClickTargets(banner_settings.SNAPSHOT_TIMEOUT)
+
+
+def invalidate_snapshots(sender, **kwargs):
+    snapshots.invalidate()
+    click_targets.invalidate()
+
+
+def remember_place_slug(sender, instance, **kwargs):
+    """
+    Keeps the slug the place is saved under, so that a renamed place is
+    dropped from the shared place cache under its old slug too
+    """
+    saved = sender.objects.filter(pk=instance.pk).values_list('slug', flat=True) if instance.pk else []
+    instance._saved_slug = saved[0] if saved else None
+
+
+def invalidate_place_snapshot(sender, instance, **kwargs):
+    snapshots.invalidate(instance.pk)
+    saved_slug = getattr(instance, '_saved_slug', None)
+    if saved_slug is not None and saved_slug != instance.slug:
+        places.invalidate(instance.slug, saved_slug)
+    else:
+        places.invalidate(instance.slug)
@@ -3,54 +3,104 @@
 import logging
 
 from django import template
+from django.core.urlresolvers import reverse
 from django.template.loader import render_to_string
+from django.utils.safestring import mark_safe
 from django.utils.translation import ugettext_lazy as _
 
+from banner_rotator import instrumentation
+from banner_rotator import settings as banner_settings
+from banner_rotator.frequency import get_frequency
 from banner_rotator.models import Banner, Place
+from banner_rotator.tokens import make_token
 
 
 logger = logging.getLogger('banner_rotator')
 
 register = template.Library()
 
+# (banner id, banner updated_at, place id, width, height) -> rendered place.html
+_fragments = {}
+
+# Stands in for the click URL in cached fragments, every render gets a freshly signed one
+CLICK_URL_MARKER = 'banner_rotator_click_url'
+
+_click_url_parts = []
+
+
+def click_url(banner_obj, place):
+    """
+    Signed click URL for one impression of banner_obj in place
+    """
+    if not _click_url_parts:
+        _click_url_parts.extend(reverse('banner_token_click', kwargs={'token': '__token__'}).rsplit('__token__', 1))
+    return make_token(banner_obj.pk, place and place.pk).join(_click_url_parts)
+
+
+def render_place(banner_obj, place):
+    """
+    Renders banner_rotator/place.html, reusing the output for the same banner and place
+    """
+    key = (banner_obj and banner_obj.pk, banner_obj and banner_obj.updated_at,
+           place.pk, place.width, place.height)
+    fragment = _fragments.get(key)
+    instrumentation.cache_hit('fragment', fragment is not None)
+    if fragment is None:
+        templates = [
+            #'banner_rotator/place_%s.html' % place.slug,
+            'banner_rotator/place.html'
+        ]
+        fragment = render_to_string(templates, {
+            'banner': banner_obj,
+            'banner_place': place,
+            'banner_click_url': CLICK_URL_MARKER
+        })
+        if banner_settings.FRAGMENT_CACHE_SIZE:
+            if len(_fragments) >= banner_settings.FRAGMENT_CACHE_SIZE:
+                _fragments.clear()
+            _fragments[key] = fragment
+    if banner_obj is None:
+        return fragment
+    return mark_safe(fragment.replace(CLICK_URL_MARKER, click_url(banner_obj, place)))
+
 
 class BannerNode(template.Node):
     def __init__(self, place_slug, varname=None):
         self.varname, self.place_slug = varname, place_slug
 
     def render(self, context):
-        try:
-            self.place = Place.objects.get(slug=self.place_slug)
-        except Place.DoesNotExist:
-            return ''
+        instrumentation.incr('slots')
+
+        # Nodes are shared between threads, so the place must not be stored on self
+        with instrumentation.measure('selection'):
+            try:
+                place = Place.objects.get_cached(self.place_slug)
+            except Place.DoesNotExist:
+                return ''
 
-        try:
-            banner_obj = Banner.objects.biased_choice(self.place)
-            banner_obj.view()
-        except Banner.DoesNotExist:
-            banner_obj = None
+            try:
+                banner_obj = Banner.objects.serve(place, get_frequency(context.get('request')))
+            except Banner.DoesNotExist:
+                banner_obj = None
 
         if self.varname:
             context.update({
                 self.varname: banner_obj,
-                '%s_place' % self.varname: self.place
+                '%s_place' % self.varname: place,
+                '%s_click_url' % self.varname: banner_obj and click_url(banner_obj, place)
             })
             return ''
         else:
-            templates = [
-                #'banner_rotator/place_%s.html' % place.slug,
-                'banner_rotator/place.html'
-            ]
-            return render_to_string(templates, {
-                'banner': banner_obj,
-                'banner_place': self.place
-            })
+            with instrumentation.measure('rendering'):
+                return render_place(banner_obj, place)
 
 
 @register.tag
 def banner(parser, token):
     """
     Use: {% banner place-slug as banner %} or {% banner place-slug %}
+
+    With "as banner" the place is in banner_place and the signed click URL in banner_click_url.
     """
     bits = token.contents.split()
 
@@ -65,3 +115,82 @@ def banner(parser, token):
         varname = None
 
     return BannerNode(place_slug, varname)
+
+
+class BannersNode(template.Node):
+    def __init__(self, place_slugs, varname, unique=None):
+        self.place_slugs, self.varname, self.unique = place_slugs, varname, unique
+
+    def render(self, context):
+        instrumentation.incr('slots', len(self.place_slugs))
+
+        with instrumentation.measure('selection'):
+            places = Place.objects.in_bulk_cached(self.place_slugs)
+            places = [places[slug] for slug in self.place_slugs if slug in places]
+            chosen = Banner.objects.serve_many(places, unique=self.unique,
+                                               frequency=get_frequency(context.get('request')))
+
+        context.update({
+            self.varname: dict((place.slug, banner_obj) for place, banner_obj in zip(places, chosen)),
+            '%s_places' % self.varname: dict((place.slug, place) for place in places),
+            '%s_click_urls' % self.varname: dict((place.slug, click_url(banner_obj, place))
+                                                 for place, banner_obj in zip(places, chosen) if banner_obj)
+        })
+        return ''
+
+
+@register.tag
+def banners(parser, token):
+    """
+    Use: {% banners place-slug another-slug as slots %}
+    or {% banners place-slug another-slug unique campaign as slots %}
+
+    slots is a dict place slug -> banner (or None), slots_places is a dict place slug -> place
+    and slots_click_urls a dict place slug -> signed click URL.
+    With "unique banner" or "unique campaign" no banner or campaign is shown twice.
+    """
+    bits = token.contents.split()
+
+    if len(bits) < 4 or bits[-2] != 'as':
+        raise template.TemplateSyntaxError(_("banners tag must end with as <variable>"))
+
+    varname = bits[-1]
+    place_slugs = bits[1:-2]
+    unique = None
+    if len(place_slugs) > 2 and place_slugs[-2] == 'unique':
+        unique = place_slugs[-1]
+        place_slugs = place_slugs[:-2]
+        if unique not in ('banner', 'campaign'):
+            raise template.TemplateSyntaxError(_("banners tag can only be unique by banner or campaign"))
+
+    return BannersNode(place_slugs, varname, unique)
+
+
+class BannerJsNode(template.Node):
+    def __init__(self, place_slug):
+        self.place_slug = place_slug
+
+    def render(self, context):
+        return render_to_string('banner_rotator/place_js.html', {
+            'place_slug': self.place_slug,
+            'fragments_url': reverse('banner_fragments'),
+            'impressions_url': reverse('banner_impressions'),
+        })
+
+
+@register.tag
+def banner_js(parser, token):
+    """
+    Use: {% banner_js place-slug %}
+
+    Renders an empty slot that is filled in the browser, so the banner still
+    rotates and its impression is counted when the page itself is cached.
+    All slots of a page are fetched with one request and their impressions
+    reported to the impressions beacon with another.
+    """
+    bits = token.contents.split()
+
+    if len(bits) != 2:
+        raise template.TemplateSyntaxError(_("banner_js tag takes one argument"))
+
+    return BannerJsNode(bits[1])
@@ -1,10 +1,103 @@
+import csv
+import datetime
+import json
+import re
+import sys
+import threading
+
+from django.contrib import admin
+from django.contrib.auth.models import User
+from django.core.management import call_command
+from django.core.signing import BadSignature
+from django.core.urlresolvers import reverse
+from django.db import DatabaseError, transaction
+from django.http import Http404
 from django.test import TestCase
+from django.test.client import RequestFactory
+from django.test.utils import override_settings
+try:
+    # Django 1.4
+    from django.conf.urls import include, patterns, url
+except ImportError:
+    from django.conf.urls.defaults import include, patterns, url
+from django.utils import unittest
+from . import counters
+from . import instrumentation
+from . import settings as banner_settings
+from . import views
+from .frequency import VisitorFrequency
 from .managers import pick
+if sys.version_info >= (3, 7):
+    import asyncio
+    from . import aio
+else:
+    asyncio = None
+from . import pacing
+from .pacing import Pacer
+from .sampling import AliasSampler
+from .backends import RedisCounterBackend, LocalRedis
+from .click_filter import RotatingBloomFilter, accept_click
+from .click_queue import save_clicks
+from .counters import ViewBuffer, get_hour, write_stats
+from .admin import BannerAdmin
+from .models import Banner, Campaign, Place, Click, BannerStat
+from .snapshot import PlaceSnapshot, click_targets, snapshots, places
+from .templatetags.banners import CLICK_URL_MARKER, _fragments, render_place
+from .tokens import VIEW_SALT, make_token, parse_token, is_countable
+
+
+urlpatterns = patterns('',
+    url(r'^admin/', include(admin.site.urls)),
+    url(r'', include('banner_rotator.urls')),
+)
+
+
+class override_banner_settings(object):
+    """
+    Changes BANNER_ROTATOR settings read into banner_rotator.settings for a with block,
+    or between enable() and disable()
+    """
+
+    def __init__(self, **values):
+        self.values = values
+
+    def enable(self):
+        self.saved = dict((name, getattr(banner_settings, name)) for name in self.values)
+        for name, value in self.values.items():
+            setattr(banner_settings, name, value)
+
+    def disable(self):
+        for name, value in self.saved.items():
+            setattr(banner_settings, name, value)
+
+    def __enter__(self):
+        self.enable()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.disable()
 
 
 class BaseBannerTest(TestCase):
     fixtures = ['test_data']
 
+    def override_banner_settings(self, **values):
+        """Changes banner_rotator.settings for the rest of the test"""
+        override = override_banner_settings(**values)
+        override.enable()
+        self.addCleanup(override.disable)
+
+    def add_top_place(self, **fields):
+        """Shows banner 1, running since yesterday, in a new place 'top' with empty snapshot and place caches"""
+        snapshots.invalidate()
+        places.invalidate()
+        place = Place.objects.create(name='Top', slug='top', **fields)
+        now = datetime.datetime.today()
+        # The fragments render banner.file.url, which raises for a banner without a file
+        Banner.objects.filter(pk=1).update(start_at=now - datetime.timedelta(days=1),
+                                           finish_at=now + datetime.timedelta(days=1), file='banners/top.png')
+        Banner.objects.get(pk=1).places.add(place)
+        return place
+
 
 class BannerManagerTest(BaseBannerTest):
 
@@ -31,3 +124,640 @@ class BannerManagerTest(BaseBannerTest):
         ]
         result = pick(choices)
         self.assertTrue(result)
+
+    def test_alias_sampler(self):
+        sampler = AliasSampler([('never', 0), ('rare', 1), ('often', 9)])
+        self.assertEqual(len(sampler), 2)
+        results = [sampler.choice() for i in range(1000)]
+        self.assertFalse('never' in results)
+        self.assertTrue(results.count('often') > results.count('rare'))
+
+        self.assertRaises(ValueError, AliasSampler, [('never', 0)])
+        self.assertEqual(pick([]), None)
+
+
+class BiasedChoiceTest(BaseBannerTest):
+
+    def setUp(self):
+        snapshots.invalidate()
+        self.place = Place.objects.create(name='Top', slug='top')
+        now = datetime.datetime.today()
+        self.banner = Banner.objects.get(pk=1)
+        self.banner.start_at = now - datetime.timedelta(days=1)
+        self.banner.finish_at = now + datetime.timedelta(days=1)
+        self.banner.save()
+        self.banner.places.add(self.place)
+
+    def test_snapshot_is_reused(self):
+        self.assertEqual(Banner.objects.biased_choice(self.place).pk, 1)
+        with self.assertNumQueries(0):
+            self.assertEqual(Banner.objects.biased_choice(self.place).pk, 1)
+
+    def test_snapshot_is_invalidated(self):
+        Banner.objects.biased_choice(self.place)
+        self.banner.places.remove(self.place)
+        self.assertRaises(Banner.DoesNotExist, Banner.objects.biased_choice, self.place)
+
+    def test_view_cap_excludes_banner(self):
+        Banner.objects.filter(pk=1).update(max_views=1)
+        banner = Banner.objects.biased_choice(self.place)
+        banner.view()
+        self.assertEqual(banner.views, 0)
+        self.assertFalse(Banner.objects.get(pk=1).is_active)
+        self.assertRaises(Banner.DoesNotExist, Banner.objects.biased_choice, self.place)
+
+    def test_serve_respects_cap(self):
+        Banner.objects.filter(pk=1).update(max_views=2, views=1)
+        Banner.objects.biased_choice(self.place)
+        # Another worker took the last impression meanwhile
+        Banner.objects.filter(pk=1).update(views=2)
+        self.assertRaises(Banner.DoesNotExist, Banner.objects.serve, self.place)
+        self.assertEqual(Banner.objects.get(pk=1).views, 2)
+        self.assertFalse(Banner.objects.get(pk=1).is_active)
+
+    def test_counts_kept_off_shared_banners(self):
+        banner = Banner.objects.biased_choice(self.place)
+
+        def count():
+            for i in range(1000):
+                snapshots.add_view(banner)
+
+        threads = [threading.Thread(target=count) for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(snapshots.total(banner, 'views'), 4000)
+        self.assertEqual(banner.views, 0)
+
+    @unittest.skipIf(asyncio is None, 'requires Python 3.7')
+    def test_async_choice_from_snapshot(self):
+        Banner.objects.biased_choice(self.place)
+        loop = asyncio.new_event_loop()
+        try:
+            with self.assertNumQueries(0):
+                self.assertEqual(loop.run_until_complete(aio.biased_choice(self.place)).pk, 1)
+            self.assertEqual(loop.run_until_complete(aio.run(max, 1, 2)), 2)
+        finally:
+            loop.close()
+
+    @unittest.skipIf(asyncio is None, 'requires Python 3.7')
+    def test_async_choice_refreshing_pacers(self):
+        Banner.objects.biased_choice(self.place)
+        self.override_banner_settings(PACING=True, PACING_INTERVAL=0)
+        self.addCleanup(pacing.reset)
+        refresh, threads = pacing.refresh, []
+
+        def recording_refresh(now):
+            # The pacers read the counter backend on every choice with a zero interval
+            threads.append(threading.current_thread())
+            return 1
+
+        pacing.refresh = recording_refresh
+        self.addCleanup(setattr, pacing, 'refresh', refresh)
+        loop = asyncio.new_event_loop()
+        self.addCleanup(loop.close)
+        self.assertEqual(loop.run_until_complete(aio.biased_choice(self.place)).pk, 1)
+        self.assertTrue(threads)
+        self.assertFalse(threading.current_thread() in threads)
+
+    def test_campaign_cap(self):
+        campaign = Campaign.objects.get(pk=1)
+        campaign.daily_max_views = 1
+        campaign.save()
+        self.assertEqual(Banner.objects.serve(self.place).pk, 1)
+        with self.assertNumQueries(0):
+            self.assertRaises(Banner.DoesNotExist, Banner.objects.biased_choice, self.place)
+
+        campaign.daily_max_views, campaign.max_views = 0, 2
+        campaign.save()
+        self.assertEqual(Banner.objects.serve(self.place).pk, 1)
+        self.assertFalse(Banner.objects.get(pk=1).is_active)
+
+    def test_frequency_cap(self):
+        frequency = VisitorFrequency()
+        with override_banner_settings(FREQUENCY_CAP=1):
+            self.assertEqual(Banner.objects.serve(self.place, frequency).pk, 1)
+            with self.assertNumQueries(0):
+                self.assertRaises(Banner.DoesNotExist, Banner.objects.biased_choice, self.place, frequency)
+
+    def test_flight_boundaries(self):
+        now = datetime.datetime(2012, 1, 1)
+        hour = datetime.timedelta(hours=1)
+        always = Banner(pk=1, weight=1)
+        scheduled = Banner(pk=2, weight=1000000, start_at=now + hour, finish_at=now + 2 * hour)
+        snapshot = PlaceSnapshot(self.place.pk, [always, scheduled])
+
+        self.assertEqual(snapshot.choice(now), always)
+        self.assertEqual(snapshot.choice(now + hour), scheduled)
+        self.assertEqual(snapshot.choice(now + 3 * hour), always)
+
+    def test_biased_choices(self):
+        other = Place.objects.create(name='Side', slug='side')
+        self.banner.places.add(other)
+        with self.assertNumQueries(1):
+            chosen = Banner.objects.biased_choices([self.place, other])
+        self.assertEqual([banner.pk for banner in chosen], [1, 1])
+
+        first, second = Banner.objects.biased_choices([self.place, other], unique='campaign')
+        self.assertEqual(first.pk, 1)
+        self.assertEqual(second, None)
+
+
+class PlaceCacheTest(BaseBannerTest):
+
+    def setUp(self):
+        places.invalidate()
+
+    def test_get_cached(self):
+        place = Place.objects.create(name='Top', slug='top')
+        self.assertEqual(Place.objects.get_cached('top'), place)
+        with self.assertNumQueries(0):
+            self.assertEqual(Place.objects.get_cached('top'), place)
+
+        place.name = 'Header'
+        place.save()
+        self.assertEqual(Place.objects.get_cached('top').name, 'Header')
+
+    def test_renamed_in_shared_cache(self):
+        places.backend, backend = 'default', places.backend
+        try:
+            place = Place.objects.create(name='Top', slug='top')
+            Place.objects.get_cached('top')
+            place.slug = 'header'
+            place.save()
+            self.assertRaises(Place.DoesNotExist, Place.objects.get_cached, 'top')
+            self.assertEqual(Place.objects.get_cached('header'), place)
+        finally:
+            places.invalidate('top', 'header')
+            places.backend = backend
+
+    def test_missing_slug(self):
+        self.assertRaises(Place.DoesNotExist, Place.objects.get_cached, 'missing')
+        with self.assertNumQueries(0):
+            self.assertEqual(Place.objects.in_bulk_cached(['missing']), {})
+
+
+class ViewBufferTest(BaseBannerTest):
+
+    def test_flush(self):
+        Banner.objects.filter(pk=1).update(max_views=3)
+        buffer = ViewBuffer(interval=3600)
+        with self.assertNumQueries(0):
+            for i in range(3):
+                buffer.add(1)
+        self.assertEqual(Banner.objects.get(pk=1).views, 0)
+
+        self.assertEqual(sum(buffer.flush().values()), 3)
+        banner = Banner.objects.get(pk=1)
+        self.assertEqual(banner.views, 3)
+        self.assertFalse(banner.is_active)
+        self.assertEqual(BannerStat.objects.get(banner=1, place=None).views, 3)
+
+    def test_failed_flush_keeps_counts(self):
+        buffer = ViewBuffer(interval=3600)
+        buffer.add(1)
+        buffer.add_many({(1, None, get_hour()): 2}, reserved=True)
+        write_views = counters.write_views
+
+        def failing_write_views(counts):
+            counters.write_views = write_views
+            raise DatabaseError('connection lost')
+
+        counters.write_views = failing_write_views
+        self.assertRaises(DatabaseError, buffer.flush)
+        self.assertEqual(Banner.objects.get(pk=1).views, 0)
+
+        self.assertEqual(sum(buffer.flush().values()), 3)
+        self.assertEqual(Banner.objects.get(pk=1).views, 1)
+        self.assertEqual(BannerStat.objects.get(banner=1, place=None).views, 3)
+
+
+class BannerStatTest(BaseBannerTest):
+
+    def test_concurrent_first_insert(self):
+        hour = get_hour()
+        savepoint = transaction.savepoint
+
+        def racing_savepoint(*args, **kwargs):
+            # Another process inserts the row between the UPDATE that found nothing and our INSERT
+            BannerStat.objects.create(banner_id=1, hour=hour, views=2)
+            return savepoint(*args, **kwargs)
+
+        transaction.savepoint = racing_savepoint
+        try:
+            write_stats('views', {(1, None, hour): 1})
+        finally:
+            transaction.savepoint = savepoint
+        self.assertEqual(BannerStat.objects.get(banner=1, place=None, hour=hour).views, 3)
+
+
+class FragmentCacheTest(BaseBannerTest):
+    urls = 'banner_rotator.urls'
+
+    def setUp(self):
+        _fragments.clear()
+        self.place = Place.objects.create(name='Top', slug='top', width=468, height=60)
+        self.banner = Banner.objects.get(pk=1)
+        self.banner.file.name = 'banners/top.png'
+
+    def test_hit_renders_without_query(self):
+        render_place(self.banner, self.place)
+        key, = _fragments
+        _fragments[key] = 'cached %s' % CLICK_URL_MARKER
+        with self.assertNumQueries(0):
+            html = render_place(self.banner, self.place)
+        self.assertTrue(html.startswith('cached /c/'))
+
+    def test_updated_at_invalidates(self):
+        render_place(self.banner, self.place)
+        key, = _fragments
+        _fragments[key] = 'stale'
+        self.banner.updated_at += datetime.timedelta(seconds=1)
+        html = render_place(self.banner, self.place)
+        self.assertTrue('banners/top.png' in html)
+        self.assertEqual(len(_fragments), 2)
+
+    def test_fresh_click_url(self):
+        tokens = []
+        for i in range(2):
+            href = re.search(r'href="/c/([^"/]+)/"', render_place(self.banner, self.place)).group(1)
+            tokens.append(parse_token(href))
+        self.assertEqual(len(_fragments), 1)
+        self.assertEqual([(t.banner_id, t.place_id) for t in tokens], [(1, self.place.pk)] * 2)
+        self.assertNotEqual(tokens[0].impression_id, tokens[1].impression_id)
+
+
+class ClickTest(BaseBannerTest):
+
+    def test_save_clicks(self):
+        Banner.objects.filter(pk=1).update(max_clicks=2)
+        place = Place.objects.create(name='Top', slug='top')
+        save_clicks([Click(banner_id=1, place=place), Click(banner_id=1), Click(banner_id=2)])
+
+        self.assertEqual(Click.objects.filter(banner=1, place=place).count(), 1)
+        self.assertEqual(BannerStat.objects.get(banner=1, place=place).clicks, 1)
+        self.assertEqual(BannerStat.objects.get(banner=1, place=None).clicks, 1)
+        self.assertEqual(Banner.objects.get(pk=2).click_count, 1)
+        banner = Banner.objects.get(pk=1)
+        self.assertEqual(banner.click_count, 2)
+        self.assertFalse(banner.is_active)
+
+    def test_admin_columns(self):
+        banner = Banner(views=200, click_count=3, max_clicks=10)
+        self.assertEqual(banner.admin_clicks_str(), '3 / 10')
+        self.assertEqual(banner.admin_ctr_str(), '1.50%')
+
+        Banner.objects.filter(pk=1).update(views=200, click_count=3)
+        changelist = BannerAdmin(Banner, admin.site).queryset(RequestFactory().get('/'))
+        banner = changelist.filter(campaign__isnull=False, places__isnull=True).get(pk=1)
+        self.assertEqual(round(banner.click_through_rate, 4), 0.015)
+
+    def test_archive(self):
+        old = datetime.datetime(2012, 1, 1, 10, 30)
+        save_clicks([Click(banner_id=1), Click(banner_id=1), Click(banner_id=2)])
+        Click.objects.update(datetime=old)
+        # banner 2 was counted when its click was recorded
+        BannerStat.objects.create(banner_id=2, hour=get_hour(old), clicks=1)
+
+        call_command('archive_banner_clicks', days=30, no_archive=True, chunk_size=1, verbosity=0)
+        self.assertEqual(Click.objects.count(), 0)
+        self.assertEqual(BannerStat.objects.get(banner=1, hour=get_hour(old)).clicks, 2)
+        self.assertEqual(BannerStat.objects.get(banner=2, hour=get_hour(old)).clicks, 1)
+
+    def test_archive_rebuilds_hours(self):
+        old = datetime.datetime(2012, 1, 1, 10, 30)
+        save_clicks([Click(banner_id=1) for i in range(3)] + [Click(banner_id=2)])
+        Click.objects.update(datetime=old)
+        # Only one click of banner 1 was counted, banner 2 had more clicks archived by an earlier run
+        BannerStat.objects.create(banner_id=1, hour=get_hour(old), clicks=1)
+        BannerStat.objects.create(banner_id=2, hour=get_hour(old), clicks=5)
+
+        call_command('archive_banner_clicks', days=30, no_archive=True, chunk_size=2, verbosity=0)
+        self.assertEqual(Click.objects.count(), 0)
+        self.assertEqual(BannerStat.objects.get(banner=1, hour=get_hour(old)).clicks, 3)
+        self.assertEqual(BannerStat.objects.get(banner=2, hour=get_hour(old)).clicks, 5)
+
+
+class AdminClickLogTest(BaseBannerTest):
+    urls = 'banner_rotator.tests'
+
+    def setUp(self):
+        # The superuser of the fixture, its password is not known
+        user = User.objects.get(username='admin')
+        user.set_password('admin')
+        user.save()
+        self.assertTrue(self.client.login(username='admin', password='admin'))
+        self.sizes = BannerAdmin.log_clicks_per_page, BannerAdmin.log_clicks_csv_chunk_size
+        BannerAdmin.log_clicks_per_page, BannerAdmin.log_clicks_csv_chunk_size = 2, 2
+
+    def tearDown(self):
+        BannerAdmin.log_clicks_per_page, BannerAdmin.log_clicks_csv_chunk_size = self.sizes
+
+    def test_keyset_pages(self):
+        start = datetime.datetime(2012, 1, 1, 10, 30)
+        clicks = [Click.objects.create(banner_id=1) for i in range(5)]
+        # The middle three clicks share their datetime, so pages must break ties by id
+        for click, minutes in zip(clicks, [0, 1, 1, 1, 2]):
+            Click.objects.filter(pk=click.pk).update(datetime=start + datetime.timedelta(minutes=minutes))
+        Click.objects.create(banner_id=2)
+
+        url = reverse('admin:banner_rotator_banner_log_clicks', args=[1])
+        pages, before = [], None
+        for i in range(3):
+            response = self.client.get(url, before and {'before': before} or {})
+            pages.append([click.pk for click in response.context['log_clicks']])
+            before = response.context['next_before']
+        ids = [click.pk for click in reversed(clicks)]
+        self.assertEqual(pages, [ids[:2], ids[2:4], ids[4:]])
+        self.assertEqual(before, None)
+
+    def test_csv(self):
+        Click.objects.bulk_create([Click(banner_id=1, ip='10.0.0.%s' % i) for i in range(5)])
+        response = self.client.get(reverse('admin:banner_rotator_banner_log_clicks_csv', args=[1]))
+        self.assertEqual(response['Content-Type'], 'text/csv')
+        self.assertEqual(response['Content-Disposition'], 'attachment; filename=banner-1-clicks.csv')
+        rows = list(csv.reader(response.content.decode('utf-8').splitlines()))
+        self.assertEqual(rows[0], ['datetime', 'place', 'user', 'ip', 'user_agent', 'referrer'])
+        # All clicks share one datetime, every chunk must continue by id without repeats
+        self.assertEqual([row[3] for row in rows[1:]], ['10.0.0.%s' % i for i in range(4, -1, -1)])
+
+
+class ClickFilterTest(TestCase):
+
+    def test_duplicates_and_bots(self):
+        factory = RequestFactory()
+        request = factory.get('/', REMOTE_ADDR='10.0.0.1', HTTP_USER_AGENT='Mozilla/5.0 (X11; Linux x86_64)')
+        self.assertTrue(accept_click(request, 987654))
+        self.assertFalse(accept_click(request, 987654))
+        self.assertTrue(accept_click(request, 987655))
+
+        bot = factory.get('/', REMOTE_ADDR='10.0.0.2', HTTP_USER_AGENT='Mozilla/5.0 (compatible; Googlebot/2.1)')
+        self.assertFalse(accept_click(bot, 987654))
+
+    def test_rotation_keeps_previous_window(self):
+        recent = RotatingBloomFilter(window=3600, capacity=2)
+        self.assertTrue(recent.add(b'a'))
+        self.assertTrue(recent.add(b'b'))
+        self.assertTrue(recent.add(b'c'))
+        # c rotated the filters, a is still found in the previous one
+        self.assertFalse(recent.add(b'a'))
+
+
+class CounterBackendTest(BaseBannerTest):
+
+    def test_redis_backend(self):
+        backend = RedisCounterBackend(client=LocalRedis())
+        banners = list(Banner.objects.filter(pk__in=[1, 2]))
+        banners[0].views = 10
+        backend.load(banners)
+        self.assertEqual(backend.get_many('views', [1, 2, 3]), {1: 10, 2: 0})
+
+        self.assertEqual(backend.incr_many('views', {1: 2, 2: 1}), {1: 12, 2: 1})
+        backend.load(banners)
+        self.assertEqual(banners[0].views, 12)
+
+
+class ClickTokenTest(TestCase):
+
+    def test_round_trip(self):
+        click_token = parse_token(make_token(12345, 7))
+        self.assertEqual((click_token.banner_id, click_token.place_id), (12345, 7))
+        self.assertTrue(is_countable(click_token))
+        self.assertFalse(is_countable(click_token))
+
+    def test_tampered(self):
+        token = make_token(1, 2)
+        self.assertRaises(BadSignature, parse_token, token.replace('1.', '2.', 1))
+
+
+class ClickViewTest(BaseBannerTest):
+    urls = 'banner_rotator.urls'
+
+    def setUp(self):
+        click_targets.invalidate()
+        self.place = Place.objects.create(name='Top', slug='top')
+        Banner.objects.get(pk=1).places.add(self.place)
+
+    def test_token_click(self):
+        token = make_token(1, self.place.pk, impression_id='abc123')
+        response = self.client.get(reverse('banner_token_click', kwargs={'token': token}), REMOTE_ADDR='10.0.14.1')
+        self.assertEqual(response.status_code, 302)
+        click = Click.objects.get(banner=1)
+        self.assertEqual((click.place_id, click.impression_id), (self.place.pk, 'abc123'))
+
+    def test_legacy_click(self):
+        with override_banner_settings(LEGACY_CLICKS=False):
+            response = self.client.get(reverse('banner_click', kwargs={'banner_id': 1}), REMOTE_ADDR='10.0.14.2')
+        self.assertEqual(response.status_code, 302)
+        self.assertFalse(Click.objects.filter(banner=1).exists())
+
+        # Counted by default until the deprecation is over
+        self.client.get(reverse('banner_click', kwargs={'banner_id': 1}), REMOTE_ADDR='10.0.14.3')
+        self.assertEqual(Click.objects.get(banner=1).impression_id, None)
+
+    def test_absolute_url_is_signed(self):
+        url = Banner.objects.get(pk=1).get_absolute_url()
+        response = self.client.get(url, REMOTE_ADDR='10.0.14.4')
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(parse_token(url.split('/')[-2]).banner_id, 1)
+        self.assertEqual(Click.objects.filter(banner=1).count(), 1)
+
+    def test_place_must_show_the_banner(self):
+        foreign = Place.objects.create(name='Side', slug='side')
+        for address, place_id in [(1, self.place.pk), (2, foreign.pk), (3, 987654), (4, 'x')]:
+            self.client.get(reverse('banner_click', kwargs={'banner_id': 1}), {'place': place_id},
+                            REMOTE_ADDR='10.0.15.%s' % address)
+        for address, place_id in [(5, self.place.pk), (6, foreign.pk), (7, 987654)]:
+            token = make_token(1, place_id)
+            self.client.get(reverse('banner_token_click', kwargs={'token': token}), REMOTE_ADDR='10.0.15.%s' % address)
+
+        place_ids = list(Click.objects.filter(banner=1).order_by('id').values_list('place', flat=True))
+        self.assertEqual(place_ids, [self.place.pk, None, None, None, self.place.pk, None, None])
+
+
+class ImpressionBeaconTest(BaseBannerTest):
+    urls = 'banner_rotator.urls'
+
+    def setUp(self):
+        self.place = self.add_top_place()
+
+    def test_counted_once_when_reported(self):
+        response = self.client.get(reverse('banner_fragments'), {'place': ['top', 'missing']})
+        slots = json.loads(response.content)
+        self.assertEqual(list(slots), ['top'])
+        self.assertEqual(Banner.objects.get(pk=1).views, 0)
+
+        view = slots['top']['view']
+        response = self.client.post(reverse('banner_impressions'), {'t': [view, view, make_token(1, self.place.pk)]})
+        self.assertEqual(response.status_code, 204)
+        self.assertEqual(Banner.objects.get(pk=1).views, 1)
+        self.assertEqual(BannerStat.objects.get(banner=1, place=self.place).views, 1)
+
+    def test_view_token_is_not_a_click_token(self):
+        self.assertRaises(BadSignature, parse_token, make_token(1, self.place.pk, salt=VIEW_SALT))
+
+
+class ApiTest(BaseBannerTest):
+    urls = 'banner_rotator.urls'
+
+    def setUp(self):
+        self.place = self.add_top_place(width=468, height=60)
+
+    def test_banners(self):
+        response = self.client.get(reverse('banner_api_banners'), {'place': 'top'})
+        banner = json.loads(response.content)['top']
+        self.assertEqual((banner['id'], banner['width'], banner['height']), (1, 468, 60))
+        self.assertTrue(banner['file'].endswith('banners/top.png'))
+        self.assertTrue(banner['click_url'].startswith('http://testserver/c/'))
+        self.assertEqual(Banner.objects.get(pk=1).views, 1)
+
+    def test_places_etag(self):
+        response = self.client.get(reverse('banner_api_places'), {'place': 'top'})
+        self.assertEqual(json.loads(response.content), {'top': {'name': 'Top', 'width': 468, 'height': 60}})
+        response = self.client.get(reverse('banner_api_places'), {'place': 'top'},
+                                   HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(response.status_code, 304)
+
+
+@override_settings(MIDDLEWARE_CLASSES=(
+    'django.contrib.sessions.middleware.SessionMiddleware',
+    'django.contrib.auth.middleware.AuthenticationMiddleware',
+    'banner_rotator.middleware.BannerRotatorStatsMiddleware',
+), INTERNAL_IPS=('127.0.0.1',))
+class InstrumentationTest(BaseBannerTest):
+    urls = 'banner_rotator.urls'
+
+    def setUp(self):
+        self.place = self.add_top_place()
+        self.measured = []
+        instrumentation.request_measured.connect(self.receiver)
+
+    def tearDown(self):
+        instrumentation.request_measured.disconnect(self.receiver)
+
+    def receiver(self, sender, request, stats, **kwargs):
+        self.measured.append(stats)
+
+    def test_request_measured(self):
+        before = instrumentation.totals()
+        self.client.get(reverse('banner_fragments'), {'place': ['top', 'missing']})
+        stats, = self.measured
+        self.assertEqual(stats['slots'], 1)
+        self.assertTrue(stats['selection_seconds'] > 0)
+        self.assertTrue(stats['rendering_seconds'] > 0)
+        # The snapshot of the place was built from the database
+        self.assertEqual(stats['snapshot_misses'], 1)
+        self.assertTrue(stats['queries'] > 0)
+
+        values = json.loads(self.client.get(reverse('banner_stats')).content)
+        self.assertEqual(values['requests'], before['requests'] + 1)
+        self.assertEqual(values['slots'], before['slots'] + 1)
+        self.assertTrue(values['rendering_seconds'] >= before['rendering_seconds'] + stats['rendering_seconds'])
+
+        response = self.client.get(reverse('banner_stats'), {'format': 'prometheus'})
+        self.assertTrue('banner_rotator_slots_total %s' % values['slots'] in response.content.decode('utf-8'))
+
+    def test_stats_without_auth_middleware(self):
+        request = RequestFactory().get(reverse('banner_stats'), REMOTE_ADDR='10.0.12.1')
+        self.assertRaises(Http404, views.stats, request)
+        request.META['REMOTE_ADDR'] = '127.0.0.1'
+        self.assertEqual(views.stats(request).status_code, 200)
+
+
+class VisitorFrequencyTest(TestCase):
+
+    def setUp(self):
+        override = override_banner_settings(FREQUENCY_CAP=2, CAMPAIGN_FREQUENCY_CAP=3)
+        override.enable()
+        self.addCleanup(override.disable)
+
+    def test_cookie_round_trip(self):
+        frequency = VisitorFrequency()
+        frequency.add(Banner(pk=7, campaign_id=3))
+        frequency.add(Banner(pk=7, campaign_id=3))
+        frequency.add(Banner(pk=8, campaign_id=3))
+
+        restored = VisitorFrequency.from_cookie(frequency.to_cookie())
+        self.assertTrue(restored.is_capped(Banner(pk=7, campaign_id=3)))
+        self.assertTrue(restored.is_capped(Banner(pk=9, campaign_id=3)))
+        self.assertFalse(restored.is_capped(Banner(pk=9, campaign_id=4)))
+
+    def test_tampered_cookie(self):
+        value = VisitorFrequency(counts={'b7': 5}).to_cookie()
+        self.assertEqual(VisitorFrequency.from_cookie(value.rsplit(':', 1)[0] + ':forged').counts, {})
+
+
+@override_settings(MIDDLEWARE_CLASSES=('banner_rotator.middleware.BannerRotatorFrequencyMiddleware',))
+class FrequencyMiddlewareTest(BaseBannerTest):
+    urls = 'banner_rotator.urls'
+
+    def setUp(self):
+        self.place = self.add_top_place()
+        self.override_banner_settings(FREQUENCY_CAP=1)
+
+    def test_cookie(self):
+        response = self.client.get(reverse('banner_fragments'), {'place': 'top'})
+        self.assertTrue(json.loads(response.content)['top']['view'])
+        self.assertTrue('Cookie' in response['Vary'])
+        max_age = int(response.cookies[banner_settings.FREQUENCY_COOKIE]['max-age'])
+        self.assertTrue(banner_settings.FREQUENCY_WINDOW - 5 <= max_age <= banner_settings.FREQUENCY_WINDOW)
+
+        # The client sends the cookie back, the capped banner is left out and the cookie is not rewritten
+        response = self.client.get(reverse('banner_fragments'), {'place': 'top'})
+        self.assertEqual(json.loads(response.content)['top']['view'], None)
+        self.assertTrue('Cookie' in response['Vary'])
+        self.assertFalse(banner_settings.FREQUENCY_COOKIE in response.cookies)
+
+        # Responses that did not choose banners stay cacheable for everybody
+        response = self.client.get(reverse('banner_api_places'), {'place': 'top'})
+        self.assertFalse(response.has_header('Vary') and 'Cookie' in response['Vary'])
+
+
+class PacerTest(BaseBannerTest):
+
+    def setUp(self):
+        pacing.reset()
+        self.addCleanup(pacing.reset)
+        self.override_banner_settings(PACING=True, PACING_INTERVAL=0)
+
+    def test_factor_follows_delivery(self):
+        start = datetime.datetime(2012, 1, 1)
+        banner = Banner(views=0, max_views=1000, start_at=start, finish_at=start + datetime.timedelta(seconds=1000))
+        pacer = Pacer(banner, start)
+
+        # Twice the even rate slows the banner down
+        self.assertTrue(pacer.update(20, start + datetime.timedelta(seconds=10)) < 1)
+
+        # Nothing delivered speeds it up again
+        factor = pacer.factor
+        self.assertTrue(pacer.update(20, start + datetime.timedelta(seconds=20)) > factor)
+
+    def test_snapshot_weight_follows_backend_total(self):
+        now = datetime.datetime.today()
+        Banner.objects.filter(pk=1).update(max_views=1000, start_at=now - datetime.timedelta(hours=1),
+                                           finish_at=now + datetime.timedelta(seconds=1000))
+        banner = Banner.objects.get(pk=1)
+        snapshot = PlaceSnapshot(1, [banner])
+        self.assertEqual(snapshot.choice(now), banner)
+        sampler, weight = snapshot._sampler, pacing.get_weight(banner, now)
+
+        # Other places and processes delivered far ahead of the even rate meanwhile
+        Banner.objects.filter(pk=1).update(views=500)
+        later = now + datetime.timedelta(seconds=10)
+        self.assertEqual(snapshot.choice(later), banner)
+        self.assertTrue(snapshot._sampler is not sampler)
+        self.assertTrue(pacing.get_weight(banner, later) < weight)
+
+    def test_idle_pacers_are_dropped(self):
+        now = datetime.datetime.today()
+        banner = Banner(pk=1, weight=5, max_views=1000, start_at=now, finish_at=now + datetime.timedelta(days=1))
+        pacing.get_weight(banner, now)
+        pacing.refresh(now)
+        self.assertTrue(1 in pacing._pacers)
+
+        # No snapshot weighed the banner since it left them
+        pacing._pacers[1].weighed_at -= banner_settings.SNAPSHOT_TIMEOUT + 1
+        with self.assertNumQueries(0):
+            pacing.refresh(now)
+        self.assertFalse(1 in pacing._pacers)
@@ -0,0 +1,107 @@
+#-*- coding:utf-8 -*-
+
+import binascii
+import os
+import threading
+from collections import namedtuple
+from time import time
+
+from django.core.signing import Signer, BadSignature
+from django.utils.http import int_to_base36, base36_to_int
+
+from banner_rotator import settings as banner_settings
+
+
+ClickToken = namedtuple('ClickToken', 'banner_id place_id timestamp impression_id')
+
+# Click URLs and impression beacons are signed apart, so one cannot be replayed as the other
+CLICK_SALT = 'banner_rotator.click'
+VIEW_SALT = 'banner_rotator.view'
+
+_signers = {}
+
+
+def get_signer(salt=CLICK_SALT):
+    if salt not in _signers:
+        _signers[salt] = Signer(salt=salt)
+    return _signers[salt]
+
+
+def new_impression_id():
+    return binascii.hexlify(os.urandom(6)).decode('ascii')
+
+
+def make_token(banner_id, place_id=None, timestamp=None, impression_id=None, salt=CLICK_SALT):
+    """
+    Signed "banner.place.timestamp.impression" string, all numbers in base 36
+    """
+    value = '.'.join([
+        int_to_base36(banner_id),
+        int_to_base36(place_id or 0),
+        int_to_base36(int(timestamp or time())),
+        impression_id or new_impression_id(),
+    ])
+    return get_signer(salt).sign(value)
+
+
+def parse_token(token, salt=CLICK_SALT):
+    """
+    Returns the ClickToken signed in token, raises BadSignature if it was not made by make_token
+    """
+    value = get_signer(salt).unsign(token)
+    try:
+        banner_id, place_id, timestamp, impression_id = value.split('.')
+        return ClickToken(base36_to_int(banner_id), base36_to_int(place_id) or None,
+                          base36_to_int(timestamp), impression_id)
+    except ValueError:
+        raise BadSignature('Malformed click token')
+
+
+class RecentSet(object):
+    """
+    Remembers values for window to 2 * window seconds in two rotating sets
+    of at most max_size values each, so memory stays bounded.
+    Subclasses can keep the values in another kind of set, see new_set().
+    """
+
+    def __init__(self, window, max_size):
+        self.window = window
+        self.max_size = max_size
+        self._current, self._previous = self.new_set(), self.new_set()
+        self._rotated_at = time()
+        self._lock = threading.Lock()
+
+    def new_set(self):
+        """
+        An empty set supporting add(), len() and in
+        """
+        return set()
+
+    def add(self, value):
+        """
+        Returns False if value was already seen
+        """
+        with self._lock:
+            if time() - self._rotated_at >= self.window or len(self._current) >= self.max_size:
+                self._current, self._previous = self.new_set(), self._current
+                self._rotated_at = time()
+            if value in self._current or value in self._previous:
+                return False
+            self._current.add(value)
+            return True
+
+
+_seen_impressions = {
+    CLICK_SALT: RecentSet(banner_settings.CLICK_TOKEN_MAX_AGE, 100000),
+    VIEW_SALT: RecentSet(banner_settings.CLICK_TOKEN_MAX_AGE, 100000),
+}
+
+
+def is_countable(click_token, salt=CLICK_SALT):
+    """
+    False for tokens that are too old, from the future or already counted in this process
+    """
+    age = time() - click_token.timestamp
+    if age < -60 or age > banner_settings.CLICK_TOKEN_MAX_AGE:
+        return False
+    return _seen_impressions[salt].add(click_token.impression_id)
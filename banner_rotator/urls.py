@@ -8,5 +8,11 @@ except ImportError:
 
 
 urlpatterns = patterns('banner_rotator.views',
-    url(r'^click/(?P<banner_id>\d{1,4})/$', 'click', name='banner_click'),
+    url(r'^click/(?P<banner_id>\d+)/$', 'click', name='banner_click'),
+    url(r'^c/(?P<token>[\w.:-]+)/$', 'token_click', name='banner_token_click'),
+    url(r'^fragments/$', 'fragments', name='banner_fragments'),
+    url(r'^impressions/$', 'impressions', name='banner_impressions'),
+    url(r'^api/places/$', 'api_places', name='banner_api_places'),
+    url(r'^api/banners/$', 'api_banners', name='banner_api_banners'),
+    url(r'^stats/$', 'stats', name='banner_stats'),
 )
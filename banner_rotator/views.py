@@ -1,12 +1,224 @@
 #-*- coding:utf-8 -*-
 
-from django.shortcuts import redirect, get_object_or_404
+import base64
+import json
+import warnings
+try:
+    from hashlib import md5
+except ImportError:
+    from md5 import md5
 
-from banner_rotator.models import Banner
+from django.conf import settings
+from django.core.signing import BadSignature
+from django.http import Http404, HttpResponse, HttpResponseRedirect, HttpResponseNotModified
+from django.utils.cache import patch_cache_control
+from django.utils.http import parse_etags, quote_etag
+from django.views.decorators.cache import never_cache
+from django.views.decorators.csrf import csrf_exempt
+
+from banner_rotator import instrumentation
+from banner_rotator import settings as banner_settings
+from banner_rotator.click_queue import record_click
+from banner_rotator.counters import count_views
+from banner_rotator.frequency import get_frequency
+from banner_rotator.models import Banner, Place
+from banner_rotator.snapshot import click_targets, snapshots
+from banner_rotator.templatetags.banners import click_url, render_place
+from banner_rotator.tokens import VIEW_SALT, make_token, parse_token, is_countable
+
+
+# Most impressions accepted from one beacon request
+MAX_BEACON_VIEWS = 100
+
+PIXEL = base64.b64decode('R0lGODlhAQABAIAAAAAAAP///yH5BAEAAAAALAAAAAABAAEAAAIBRAA7')
 
 
 def click(request, banner_id):
-    banner = get_object_or_404(Banner, pk=banner_id)
-    banner.click(request)
+    """
+    Redirects to the banner URL from the in-memory click targets, without loading the banner.
+    The click is only recorded while BANNER_ROTATOR_LEGACY_CLICKS is on (deprecated, see token_click).
+    """
+    target = click_targets.get(Banner.objects, int(banner_id))
+    if target is None:
+        raise Http404
+
+    if banner_settings.LEGACY_CLICKS:
+        try:
+            place_id = int(request.GET.get('place'))
+        except (TypeError, ValueError):
+            place_id = None
+        if place_id not in target.place_ids:
+            place_id = None
+
+        warnings.warn('Clicks on unsigned banner_click URLs can be replayed, link to banner_click_url instead; '
+                      'set BANNER_ROTATOR_LEGACY_CLICKS = False to stop counting them', DeprecationWarning)
+        with instrumentation.measure('counting'):
+            record_click(request, int(banner_id), place_id)
+
+    return HttpResponseRedirect(target.url)
+
+
+def token_click(request, token):
+    """
+    Click on a signed URL made by tokens.make_token. The token is checked
+    without touching the database and expired or replayed clicks are
+    redirected without being recorded.
+    """
+    try:
+        click_token = parse_token(token)
+    except BadSignature:
+        raise Http404
+
+    target = click_targets.get(Banner.objects, click_token.banner_id)
+    if target is None:
+        raise Http404
+
+    if is_countable(click_token):
+        place_id = click_token.place_id if click_token.place_id in target.place_ids else None
+        with instrumentation.measure('counting'):
+            record_click(request, click_token.banner_id, place_id, click_token.impression_id)
+
+    return HttpResponseRedirect(target.url)
+
+
+def get_places(request):
+    """
+    Places for the ?place=slug&place=slug parameters in slug order, from the place cache
+    """
+    slugs = request.GET.getlist('place')
+    found = Place.objects.in_bulk_cached(slugs)
+    return [found[slug] for slug in sorted(set(slugs)) if slug in found]
+
+
+def get_unique(request):
+    unique = request.GET.get('unique')
+    return unique if unique in ('banner', 'campaign') else None
+
+
+def place_data(place):
+    return {'name': place.name, 'width': place.width, 'height': place.height}
+
+
+@never_cache
+def fragments(request):
+    """
+    Rendered banners for the places in ?place=slug&place=slug, used by the
+    banner_js tag on cached pages. Returns {slug: {"html": ..., "view": token}};
+    the impression is only counted when the view token comes back to the
+    impressions beacon, i.e. when the banner was actually shown.
+    """
+    unique = get_unique(request)
+    with instrumentation.measure('selection'):
+        places = get_places(request)
+        frequency = get_frequency(request)
+        chosen = Banner.objects.biased_choices(places, unique=unique, frequency=frequency)
+        if frequency is not None:
+            # Shown as soon as the browser gets them, so they count for the visitor right away
+            for banner_obj in chosen:
+                if banner_obj is not None:
+                    frequency.add(banner_obj)
+    instrumentation.incr('slots', len(places))
+
+    result = {}
+    with instrumentation.measure('rendering'):
+        for place, banner_obj in zip(places, chosen):
+            result[place.slug] = {
+                'html': render_place(banner_obj, place),
+                'view': banner_obj and make_token(banner_obj.pk, place.pk, salt=VIEW_SALT),
+            }
+    return HttpResponse(json.dumps(result), content_type='application/json')
+
+
+@csrf_exempt
+@never_cache
+def impressions(request):
+    """
+    Impression beacon: counts the signed view tokens in the t parameters, sent
+    by POST (navigator.sendBeacon) or GET (answered with a 1x1 GIF pixel).
+    Bad, expired and replayed tokens are ignored without a database lookup.
+    """
+    params = request.POST if request.method == 'POST' else request.GET
+    view_tokens = []
+    for token in params.getlist('t')[:MAX_BEACON_VIEWS]:
+        try:
+            view_token = parse_token(token, salt=VIEW_SALT)
+        except BadSignature:
+            continue
+        if view_token.place_id and is_countable(view_token, salt=VIEW_SALT):
+            view_tokens.append(view_token)
+
+    if view_tokens:
+        # The banners come from the place snapshots, so caps are checked as for server-side impressions
+        found = snapshots.get_many(Banner.objects, set(view_token.place_id for view_token in view_tokens))
+        banners = dict(((place_id, banner.pk), banner) for place_id, snapshot in found.items()
+                       for banner in snapshot.banners)
+        views = [(banners[view_token.place_id, view_token.banner_id], view_token.place_id)
+                 for view_token in view_tokens if (view_token.place_id, view_token.banner_id) in banners]
+        count_views(views)
+
+    if request.method == 'POST':
+        return HttpResponse(status=204)
+    return HttpResponse(PIXEL, content_type='image/gif')
+
+
+def api_places(request):
+    """
+    JSON metadata of the places in ?place=slug&place=slug. It only changes
+    when a place is edited, so it carries an ETag and may be cached for
+    BANNER_ROTATOR_PLACE_CACHE_TIMEOUT seconds.
+    """
+    content = json.dumps(dict((place.slug, place_data(place)) for place in get_places(request)), sort_keys=True)
+    etag = md5(content.encode('utf-8')).hexdigest()
+
+    if etag in parse_etags(request.META.get('HTTP_IF_NONE_MATCH', '')):
+        response = HttpResponseNotModified()
+    else:
+        response = HttpResponse(content, content_type='application/json')
+    response['ETag'] = quote_etag(etag)
+    patch_cache_control(response, public=True, max_age=banner_settings.PLACE_CACHE_TIMEOUT)
+    return response
+
+
+@never_cache
+def api_banners(request):
+    """
+    Chooses and counts a banner for each place in ?place=slug&place=slug
+    (optionally &unique=banner or &unique=campaign), as the banners tag does.
+    Returns {slug: banner or null} with absolute file and signed click URLs.
+    """
+    unique = get_unique(request)
+    with instrumentation.measure('selection'):
+        places = get_places(request)
+        chosen = Banner.objects.serve_many(places, unique=unique, frequency=get_frequency(request))
+    instrumentation.incr('slots', len(places))
+
+    result = {}
+    for place, banner_obj in zip(places, chosen):
+        result[place.slug] = banner_obj and {
+            'id': banner_obj.pk,
+            'file': request.build_absolute_uri(banner_obj.file.url),
+            'click_url': request.build_absolute_uri(click_url(banner_obj, place)),
+            'alt': banner_obj.alt,
+            'target': banner_obj.url_target,
+            'swf': banner_obj.is_swf(),
+            'width': place.width,
+            'height': place.height,
+        }
+    return HttpResponse(json.dumps(result), content_type='application/json')
+
+
+def stats(request):
+    """
+    Process totals collected by BannerRotatorStatsMiddleware, as JSON or
+    with ?format=prometheus in the Prometheus text format.
+    Only served to staff users and INTERNAL_IPS.
+    """
+    # request.user is only set by AuthenticationMiddleware
+    user = getattr(request, 'user', None)
+    if not (user is not None and user.is_staff or request.META.get('REMOTE_ADDR') in settings.INTERNAL_IPS):
+        raise Http404
 
-    return redirect(banner.url)
+    values = instrumentation.totals()
+    if request.GET.get('format') == 'prometheus':
+        return HttpResponse(instrumentation.prometheus(values), content_type='text/plain; version=0.0.4')
+    return HttpResponse(json.dumps(values), content_type='application/json')
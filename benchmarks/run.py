@@ -0,0 +1,189 @@
+#!/usr/bin/env python
+#-*- coding:utf-8 -*-
+"""
+Benchmarks the banner serving path against a synthetic data set.
+
+    python benchmarks/run.py --places 10 --banners 50 --clicks 10000 --output results.json
+    python benchmarks/run.py --db file --output results.json
+
+Every case reports throughput, latency percentiles and the number of
+queries per operation. Results are written as JSON so that runs of
+different versions can be compared.
+"""
+
+import datetime
+import itertools
+import json
+import os
+import platform
+import random
+import sys
+import tempfile
+import time
+from optparse import OptionParser
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def configure(db):
+    from django.conf import settings
+
+    if db == 'file':
+        name = os.path.join(tempfile.mkdtemp(prefix='banner_rotator_bench'), 'bench.sqlite3')
+    else:
+        name = ':memory:'
+
+    settings.configure(
+        DEBUG=True,  # connection.queries is only recorded in debug mode
+        DATABASES={'default': {'ENGINE': 'django.db.backends.sqlite3', 'NAME': name}},
+        INSTALLED_APPS=(
+            'django.contrib.auth',
+            'django.contrib.contenttypes',
+            'django.contrib.sessions',
+            'banner_rotator',
+        ),
+        ROOT_URLCONF='banner_rotator.urls',
+        MEDIA_URL='/media/',
+        TEMPLATE_DEBUG=False,
+    )
+    return name
+
+
+def generate(places_count, banners_count, clicks_count):
+    from banner_rotator.models import Banner, Campaign, Click, Place
+
+    now = datetime.datetime.now()
+    campaign = Campaign.objects.create(name='Benchmark')
+    places = [Place.objects.create(name='Place %s' % i, slug='place-%s' % i, width=468, height=60)
+              for i in range(places_count)]
+    banners = []
+    for i in range(banners_count):
+        banner = Banner.objects.create(campaign=campaign, name='Banner %s' % i, url='http://example.com/%s' % i,
+                                       file='banner/%s.png' % i, weight=random.randint(1, 10),
+                                       start_at=now - datetime.timedelta(days=1),
+                                       finish_at=now + datetime.timedelta(days=30))
+        banner.places.add(*random.sample(places, max(1, places_count // 2)))
+        banners.append(banner)
+
+    clicks = [Click(banner=random.choice(banners), place=random.choice(places), ip='127.0.0.1',
+                    user_agent='Mozilla/5.0 (benchmark)', referrer='http://example.com/')
+              for i in range(clicks_count)]
+    for start in range(0, len(clicks), 500):
+        Click.objects.bulk_create(clicks[start:start + 500])
+    return places, banners
+
+
+def measure(name, func, iterations):
+    from django.db import connection, reset_queries
+
+    func()  # warm up caches the way a long running worker would have them
+    timings = []
+    queries = 0
+    for i in range(iterations):
+        reset_queries()
+        started = time.time()
+        func()
+        timings.append(time.time() - started)
+        queries += len(connection.queries)
+
+    timings.sort()
+    total = sum(timings)
+
+    def percentile(p):
+        return timings[min(len(timings) - 1, int(len(timings) * p))] * 1000
+
+    result = {
+        'name': name,
+        'iterations': iterations,
+        'ops_per_second': iterations / total if total else None,
+        'latency_ms': {
+            'mean': total / iterations * 1000,
+            'p50': percentile(0.50),
+            'p90': percentile(0.90),
+            'p99': percentile(0.99),
+            'max': timings[-1] * 1000,
+        },
+        'queries_per_op': float(queries) / iterations,
+    }
+    sys.stderr.write('%-16s %10.1f ops/s  p50 %7.3f ms  p99 %7.3f ms  %5.2f queries\n' % (
+        name, result['ops_per_second'] or 0, result['latency_ms']['p50'], result['latency_ms']['p99'],
+        result['queries_per_op']))
+    return result
+
+
+def run(options):
+    from django.contrib.auth.models import AnonymousUser
+    from django.core.management import call_command
+    from django.template import Context, Template
+    from django.test.client import RequestFactory
+
+    from banner_rotator import get_version
+    from banner_rotator import views
+    from banner_rotator.models import Banner
+    from banner_rotator.tokens import make_token
+
+    call_command('syncdb', interactive=False, verbosity=0)
+    random.seed(options.seed)
+    places, banners = generate(options.places, options.banners, options.clicks)
+
+    factory = RequestFactory()
+    addresses = itertools.count()
+
+    def click_request():
+        # Every request from its own address, repeated clicks would be dropped as duplicates
+        address = next(addresses)
+        request = factory.get('/click/%s/' % banners[0].pk, {'place': places[0].pk},
+                              REMOTE_ADDR='10.%s.%s.%s' % (address >> 16 & 255, address >> 8 & 255, address & 255),
+                              HTTP_USER_AGENT='Mozilla/5.0 (benchmark)')
+        request.user = AnonymousUser()
+        return request
+
+    tag = Template('{%% load banners %%}{%% banner %s %%}' % places[0].slug)
+    banner = Banner.objects.get(pk=banners[0].pk)
+
+    cases = [
+        ('tag_render', lambda: tag.render(Context())),
+        ('biased_choice', lambda: Banner.objects.biased_choice(places[0])),
+        ('view', lambda: banner.view(places[0])),
+        ('click', lambda: banner.click(click_request(), places[0])),
+        ('click_view', lambda: views.token_click(click_request(), make_token(banners[0].pk, places[0].pk))),
+    ]
+    results = [measure(name, func, options.iterations) for name, func in cases
+               if not options.cases or name in options.cases]
+
+    return {
+        'version': get_version(),
+        'python': platform.python_version(),
+        'db': options.db,
+        'dataset': {'places': options.places, 'banners': options.banners, 'clicks': options.clicks},
+        'seed': options.seed,
+        'created_at': datetime.datetime.now().isoformat(),
+        'results': results,
+    }
+
+
+def main():
+    parser = OptionParser(usage='%prog [options]')
+    parser.add_option('--db', choices=['memory', 'file'], default='memory',
+                      help='SQLite in memory or in a temporary file (default: memory)')
+    parser.add_option('--places', type='int', default=10)
+    parser.add_option('--banners', type='int', default=50)
+    parser.add_option('--clicks', type='int', default=10000)
+    parser.add_option('--iterations', type='int', default=1000)
+    parser.add_option('--seed', type='int', default=0)
+    parser.add_option('--case', dest='cases', action='append',
+                      help='only run this case (tag_render, biased_choice, view, click, click_view)')
+    parser.add_option('--output', help='write the JSON results to this file instead of stdout')
+    options, args = parser.parse_args()
+
+    configure(options.db)
+    report = json.dumps(run(options), indent=2)
+    if options.output:
+        with open(options.output, 'w') as output:
+            output.write(report)
+    else:
+        sys.stdout.write(report + '\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -13,6 +13,7 @@ setup(name='django-banner-rotator',
     include_package_data = True,
     zip_safe=False,
     packages=find_packages(),
+    install_requires=['Django>=1.4'],
     classifiers=[
         'Environment :: Web Environment',
         'Framework :: Django',